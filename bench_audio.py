@@ -0,0 +1,54 @@
+"""
+Micro-benchmark of `Audio` (audioop) vs `NumpyAudio` DSP operations
+
+    python bench_audio.py [users]
+"""
+import os
+import sys
+import timeit
+
+import numpy as np
+
+from utils import Audio, NumpyAudio, batch_rms
+
+DURATIONS = [0.02, 0.1, 0.5, 2, 10]
+RATE = 48000
+
+
+def bench(stmt, number):
+    return min(timeit.repeat(stmt, number=number, repeat=5)) / number
+
+
+def main(users=16):
+    print(f"{'op':>10} {'duration':>9} {'audioop':>12} {'numpy':>12} {'speedup':>8}")
+    for duration in DURATIONS:
+        frames = int(RATE * duration)
+        audio = Audio(channels=2, width=2, rate=RATE, data=os.urandom(frames * 4))
+        np_audio = NumpyAudio.from_audio(audio)
+        mono, np_mono = audio.to_mono(), np_audio.to_mono()
+        number = max(1, int(2 / duration))
+        ops = dict(
+            rms=(lambda: audio.rms, lambda: np_audio.rms),
+            to_mono=(audio.to_mono, np_audio.to_mono),
+            to_stereo=(mono.to_stereo, np_mono.to_stereo),
+            mul=(lambda: audio * 0.5, lambda: np_audio * 0.5),
+            amplify=(lambda: audio * 2, lambda: np_audio * 2),
+            combine=(lambda: audio.combine(audio), lambda: np_audio.combine(audio)),
+            silence=(lambda: audio.silence(frames), lambda: np_audio.silence(frames)),
+            batch_rms=(lambda: [a.rms for a in [audio] * users], lambda: batch_rms([audio] * users)),
+        )
+        for name, (audioop_op, numpy_op) in ops.items():
+            expected, result = audioop_op(), numpy_op()
+            if isinstance(expected, Audio):
+                expected, result = bytes(expected.data), bytes(result.data)
+            assert np.array_equal(expected, result), f"{name} of numpy does not match audioop"
+            audioop_time = bench(audioop_op, number)
+            numpy_time = bench(numpy_op, number)
+            print(
+                f'{name:>10} {duration:>8}s {audioop_time * 1e6:>10.1f}us {numpy_time * 1e6:>10.1f}us'
+                f' {audioop_time / numpy_time:>7.2f}x'
+            )
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,86 @@
+"""
+Benchmark of member name resolution: linear `fuzzywuzzy.process.extractOne` vs `NameIndex`
+
+    python bench_names.py [queries]
+"""
+import random
+import string
+import sys
+import time
+
+from fuzzywuzzy.process import extractOne as fuzzy_select
+
+from names import NameIndex
+
+SIZES = [1000, 10000, 100000]
+SYLLABLES = ['ka', 'ro', 'mi', 'na', 'te', 'lo', 'vi', 'sa', 'du', 'ne', 'zo', 'ri', 'ba', 'to', 'ma', 'gu']
+
+
+def random_name(rng: random.Random) -> str:
+    name = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+    if rng.random() < 0.3:
+        name += str(rng.randint(1, 999))
+    return name
+
+
+def typo(name: str, rng: random.Random) -> str:
+    i = rng.randrange(len(name))
+    return name[:i] + rng.choice(string.ascii_lowercase) + name[i + 1:]
+
+
+def prefix(name: str, rng: random.Random) -> str:
+    return name[:rng.randint(3, 4)]
+
+
+def substring(name: str, rng: random.Random) -> str:
+    size = min(len(name), rng.randint(4, 6))
+    i = rng.randint(0, len(name) - size)
+    return name[i:i + size]
+
+
+def short(name: str, rng: random.Random) -> str:
+    """A short name nobody may have, like "Ivan" said to a guild without Ivans"""
+    return ''.join(rng.choice(SYLLABLES) for _ in range(2)).capitalize()
+
+
+# Full names with a typo, first letters of a name, a part of it, first letters with a typo and a short word
+QUERIES = dict(
+    typo=typo, prefix=prefix, substring=substring, prefix_typo=lambda name, rng: typo(prefix(name, rng), rng),
+    short=short,
+)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main(queries=20):
+    rng = random.Random(0)
+    print(f"{'members':>8} {'query':>11} {'build':>9} {'linear':>11} {'index':>11} {'speedup':>8} {'agree':>6}")
+    for size in SIZES:
+        members = {i: (random_name(rng), random_name(rng) if rng.random() < 0.5 else None) for i in range(size)}
+        index = NameIndex()
+        _, build_time = timed(lambda: [index.add(i, i, names) for i, names in members.items()])
+        candidates = [name for names in members.values() for name in names if name]
+        for kind, make_query in QUERIES.items():
+            linear_time = index_time = 0
+            agree = 0
+            # Linear scan over 100k names takes seconds, so it gets fewer queries
+            number = max(1, queries * 1000 // size)
+            for _ in range(number):
+                query = make_query(rng.choice(candidates), rng)
+                (_, linear_score), elapsed = timed(fuzzy_select, query, candidates)
+                linear_time += elapsed
+                (_, index_score), elapsed = timed(index.resolve, query)
+                index_time += elapsed
+                agree += index_score == linear_score
+            print(
+                f'{size:>8} {kind:>11} {build_time:>8.2f}s {linear_time / number * 1e3:>9.1f}ms'
+                f' {index_time / number * 1e3:>9.2f}ms {linear_time / index_time:>7.0f}x {agree / number:>6.0%}'
+            )
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
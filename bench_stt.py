@@ -0,0 +1,145 @@
+"""
+Hedged STT against local stand-in servers of Yandex and Google
+
+    python bench_stt.py
+
+Every scenario sets the delay and the answer of both stand-ins, then checks
+the transcript (or the error) of `voice.speech_to_text` and how long it took.
+"""
+import asyncio
+import logging
+import os
+import time
+
+from aiohttp import web
+
+HOST = '127.0.0.1'
+PORT = int(os.getenv('STAND_IN_PORT', 8765))
+HEDGE_DELAY = 0.2
+# STT clients read these on import
+os.environ.update(
+    YANDEX_API_KEY='stand-in',
+    YANDEX_STT_URL=f'http://{HOST}:{PORT}/yandex',
+    GOOGLE_STT_URL=f'http://{HOST}:{PORT}/google',
+    STT_OPUS='0',
+)
+
+import voice  # noqa: E402
+from clients import clients  # noqa: E402
+from utils import Audio, EmptyUtterance, language  # noqa: E402
+
+
+class StandIn:
+    """STT server answering `text` after `delay` seconds, or failing with `status`"""
+    def __init__(self, name: str):
+        self.name = name
+        self.delay = 0
+        self.text = ''
+        self.status = 200
+        self.requests = 0
+
+    def configure(self, delay: float, text: str, status=200):
+        self.delay, self.text, self.status = delay, text, status
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await request.read()
+        await asyncio.sleep(self.delay)
+        if self.status >= 400:
+            return web.json_response(dict(error='stand-in failure'), status=self.status)
+        return web.json_response(self.body())
+
+    def body(self) -> dict:
+        raise NotImplementedError
+
+
+class GoogleStandIn(StandIn):
+    def body(self):
+        # Google omits results when nothing was recognized
+        return dict(results=[dict(alternatives=[dict(transcript=self.text)])]) if self.text else {}
+
+
+class YandexStandIn(StandIn):
+    def body(self):
+        return dict(result=self.text)
+
+
+# Name, Yandex (primary for 'ru') and Google (secondary) as (delay, text, status), expected transcript or error
+SCENARIOS = [
+    ('fast primary', (0.05, 'привет', 200), (0.05, 'hello', 200), 'привет'),
+    ('slow primary', (2.0, 'привет', 200), (0.05, 'hello', 200), 'hello'),
+    ('empty primary', (0.05, '', 200), (0.05, 'hello', 200), 'hello'),
+    ('failed primary', (0.05, '', 500), (0.05, 'hello', 200), 'hello'),
+    ('both empty', (0.05, '', 200), (0.05, '', 200), EmptyUtterance),
+    ('empty and failed', (0.05, '', 200), (0.05, '', 500), EmptyUtterance),
+    ('failed and empty', (0.05, '', 500), (0.05, '', 200), EmptyUtterance),
+    ('both failed', (0.05, '', 500), (0.05, '', 500), Exception),
+]
+
+
+async def stand_in_headers():
+    return {}
+
+
+async def run_scenarios(yandex: StandIn, google: StandIn, audio: Audio):
+    voice.STT_HEDGE = str(HEDGE_DELAY)
+    print(f"{'scenario':>18} {'result':>16} {'time':>7} {'yandex':>7} {'google':>7}")
+    for name, yandex_config, google_config, expected in SCENARIOS:
+        yandex.configure(*yandex_config)
+        google.configure(*google_config)
+        yandex.requests = google.requests = 0
+        start = time.perf_counter()
+        try:
+            result = await voice.speech_to_text(audio)
+        except Exception as exc:
+            result = exc
+        elapsed = time.perf_counter() - start
+        print(
+            f'{name:>18} {type(result).__name__ if isinstance(result, Exception) else result:>16} '
+            f'{elapsed * 1e3:>5.0f}ms {yandex.requests:>7} {google.requests:>7}'
+        )
+        if isinstance(expected, type):
+            assert isinstance(result, expected), f"{name}: expected {expected.__name__}, got {result!r}"
+        else:
+            assert result == expected, f"{name}: expected {expected!r}, got {result!r}"
+        # A good answer before the hedge delay does not bother the secondary
+        assert name != 'fast primary' or google.requests == 0, f"{name}: secondary was queried"
+        # The loser is cancelled instead of being waited for
+        assert elapsed < HEDGE_DELAY + 0.5, f"{name}: took {elapsed:.3f}s"
+
+
+async def run_adaptive(yandex: StandIn, google: StandIn, audio: Audio, requests=20):
+    voice.STT_HEDGE = 'adaptive'
+    tracker = voice.stt_latencies[voice.yandex]
+    tracker.latencies.clear()
+    yandex.configure(0.05, 'привет')
+    google.configure(0.05, 'hello')
+    for _ in range(requests):
+        await voice.speech_to_text(audio)
+    print(f"Adapted hedge delay after {requests} requests: {tracker!r}")
+    assert tracker.percentile(0.95) < tracker.default, "Hedge delay did not adapt"
+
+
+async def main():
+    yandex, google = YandexStandIn('yandex'), GoogleStandIn('google')
+    app = web.Application()
+    app.router.add_post('/yandex', yandex.handle)
+    app.router.add_post('/google', google.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, HOST, PORT).start()
+    clients.google_headers = stand_in_headers
+    language.set('ru')
+    audio = Audio(channels=1, width=2, rate=16000, data=bytes(32000))
+    try:
+        await run_scenarios(yandex, google, audio)
+        await run_adaptive(yandex, google, audio)
+    finally:
+        await clients.close()
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    # Failing stand-ins are expected, do not print their tracebacks
+    logging.disable(logging.ERROR)
+    asyncio.run(main())
@@ -1,16 +1,24 @@
 import asyncio
+import io
 import os
 import re
 import logging
+from collections import deque
+from contextlib import suppress
+from typing import List
 
 import discord
 from discord import Client, File
 from discord.ext import commands
-from fuzzywuzzy.process import extractOne as fuzzy_select
-from google.protobuf.json_format import MessageToDict
+from cachetools import TTLCache
 
-from voice import DemultiplexerSink, Audio
-from utils import registry, extract_intent
+import ogg
+from clients import clients
+from tts_cache import cache as tts_cache
+from intents import detect_intent
+from names import GuildNames
+from shards import Coordinator, DiscordTransport
+from utils import Audio, registry, sync_to_async, TokenBucket
 
 logger = logging.getLogger(__name__)
 token = os.getenv('DISCORD_BOT_TOKEN')
@@ -22,9 +30,162 @@ def remove_mentions(text):
     return text
 
 
+class TextPipeline:
+    """
+    Text commands handled in the background, so that `on_message` returns right away.
+
+    Every guild has a bounded queue served by its own worker, so commands of a guild run in order
+    and a busy guild does not delay the others. At most `concurrency` commands run at once overall,
+    duplicates of a command in flight are dropped and every author is rate limited.
+    """
+    def __init__(self, handler, concurrency=4, max_pending=16, rate=0.5, burst=3):
+        self.handler = handler
+        self.max_pending = max_pending
+        self.rate = rate
+        self.burst = burst
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.queues = {}
+        self.workers = {}
+        # Forget authors whose bucket would have been refilled anyway
+        self.buckets = TTLCache(maxsize=4096, ttl=burst / rate)
+        self.in_flight = set()
+        self.dropped = 0
+        self.coalesced = 0
+        self.limited = 0
+
+    def __repr__(self):
+        return (
+            f'<{type(self).__name__}>[guilds={len(self.queues)} in_flight={len(self.in_flight)} '
+            f'dropped={self.dropped} coalesced={self.coalesced} limited={self.limited}]'
+        )
+
+    def submit(self, message, content: str) -> bool:
+        """Queue the command without waiting, return False if it is rejected"""
+        key = (message.author.id, content.lower())
+        if key in self.in_flight:
+            self.coalesced += 1
+            logger.debug(f"{self!r} coalesced '{content}' from {message.author}")
+            return False
+        bucket = self.buckets.get(message.author.id) or TokenBucket(self.rate, self.burst)
+        self.buckets[message.author.id] = bucket
+        if not bucket.take():
+            self.limited += 1
+            logger.info(f"{self!r} rate limited {message.author}")
+            return False
+        guild = message.guild and message.guild.id
+        if guild not in self.queues:
+            self.queues[guild] = asyncio.Queue(self.max_pending)
+            self.workers[guild] = asyncio.create_task(self.work(self.queues[guild]))
+        try:
+            self.queues[guild].put_nowait((key, message, content))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(f"{self!r} dropped '{content}' from {message.author}")
+            return False
+        self.in_flight.add(key)
+        return True
+
+    async def work(self, queue: asyncio.Queue):
+        while True:
+            key, message, content = await queue.get()
+            try:
+                async with self.semaphore:
+                    await self.handler(message, content)
+            except Exception as exc:
+                logger.exception(f"Can't handle '{content}' from {message.author}: {exc}")
+            finally:
+                self.in_flight.discard(key)
+
+    async def close(self):
+        for worker in self.workers.values():
+            worker.cancel()
+        await asyncio.gather(*self.workers.values(), return_exceptions=True)
+        self.queues.clear()
+        self.workers.clear()
+
+
 class OrginizerCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.pipeline = TextPipeline(
+            self.handle_message,
+            concurrency=int(os.getenv('TEXT_CONCURRENCY', 4)),
+            rate=float(os.getenv('TEXT_RATE', 0.5)),
+            burst=int(os.getenv('TEXT_BURST', 3)),
+        )
+
+        self.names = {}
+        # Guilds whose index is being built: the build and changes to apply once it is done
+        self.building = {}
+
+    def cog_unload(self):
+        asyncio.create_task(self.pipeline.close())
+
+    async def guild_names(self, guild) -> GuildNames:
+        """Name index of the guild, built in a thread on first use and then updated by the listeners below"""
+        if guild.id not in self.names:
+            if guild.id not in self.building:
+                self.building[guild.id] = (asyncio.ensure_future(self.build_names(guild)), [])
+            await asyncio.shield(self.building[guild.id][0])
+        return self.names[guild.id]
+
+    async def build_names(self, guild):
+        try:
+            # Snapshot on the loop, the client keeps changing these collections
+            members, channels = list(guild.members), list(guild.voice_channels)
+            names = await sync_to_async(GuildNames, guild, members, channels)
+            _, changes = self.building[guild.id]
+            for method, obj in changes:
+                getattr(names, method)(obj)
+            self.names[guild.id] = names
+        finally:
+            self.building.pop(guild.id, None)
+
+    def update_names(self, guild, method: str, obj):
+        if guild.id in self.names:
+            getattr(self.names[guild.id], method)(obj)
+        elif guild.id in self.building:
+            self.building[guild.id][1].append((method, obj))
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        self.update_names(member.guild, 'add_member', member)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        self.update_names(member.guild, 'remove_member', member)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if (before.name, before.nick) != (after.name, after.nick):
+            self.update_names(after.guild, 'add_member', after)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before, after):
+        if before.name == after.name:
+            return
+        for guild in self.bot.guilds:
+            member = guild.get_member(after.id)
+            if member is not None:
+                self.update_names(guild, 'add_member', member)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel):
+        if isinstance(channel, discord.VoiceChannel):
+            self.update_names(channel.guild, 'add_channel', channel)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        self.update_names(channel.guild, 'remove_channel', channel)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after):
+        if isinstance(after, discord.VoiceChannel) and before.name != after.name:
+            self.update_names(after.guild, 'add_channel', after)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.names.pop(guild.id, None)
 
     @commands.Cog.listener()
     async def on_message(self, message):
@@ -37,10 +198,12 @@ class OrginizerCog(commands.Cog):
                 break
         else:
             return
-        content = remove_mentions(message.content)
-        response = extract_intent(message.author.id, content)
-        action = response.query_result.action
-        parameters = MessageToDict(response.query_result.parameters)
+        self.pipeline.submit(message, remove_mentions(message.content))
+
+    async def handle_message(self, message, content: str):
+        intent = await detect_intent(message.author.id, content)
+        action = intent.action
+        parameters = intent.parameters
         print(f'action: {action}, parameters: {parameters}')
         if action == 'play':
             song = parameters['any']
@@ -58,9 +221,11 @@ class OrginizerCog(commands.Cog):
             query = f'{name} to {room}'
             # TODO: do not move users without accepts
             await self.move(ctx=message, query=query)
+        elif intent.text:
+            await message.channel.send(intent.text)
         else:
-            text_response = response.query_result.fulfillment_messages[0].text.text[0]
-            await message.channel.send(text_response)
+            # Discord rejects empty messages
+            logger.info(f"No reply to {content!r}: intent {intent.name!r} has no text")
 
     @commands.Cog.listener()
     async def on_command_error(self, ctx, err):
@@ -93,23 +258,14 @@ class OrginizerCog(commands.Cog):
         name = name.replace('"', '')
         name = name.strip()
         # TODO: Fuzzy matching should be implemented on the Dialogflow side
-        candidates = [m.name for m in guild.members] + [m.nick for m in guild.members if m.nick is not None]
-        fuzzy_name, name_similarity = fuzzy_select(name, candidates)
-        member = None
-        for m in guild.members:
-            if m.nick == fuzzy_name or m.name == fuzzy_name:
-                member = m
+        names = await self.guild_names(guild)
+        member, name_similarity = names.members.resolve(name)
         print('fuzzy_query:', name, 'result:', repr(member), 'similarity:', name_similarity)
 
         channel_name = query.split('to')[1]
         channel_name = channel_name.replace('"', '')
         channel_name = channel_name.strip()
-        candidates = [c.name for c in guild.voice_channels]
-        fuzzy_name, channel_similarity = fuzzy_select(channel_name, candidates)
-        channel = None
-        for c in guild.voice_channels:
-            if c.name == fuzzy_name:
-                channel = c
+        channel, channel_similarity = names.channels.resolve(channel_name)
         print('fuzzy_query:', channel_name, 'result:', repr(channel), 'similarity:', channel_similarity)
         await member.move_to(channel)
 
@@ -137,21 +293,42 @@ class OrginizerBot(commands.bot.BotBase, Client):
         discord.opus.load_opus('/usr/local/Cellar/opus/1.3.1/lib/libopus.0.dylib')
         print('OPUS:', discord.opus.is_loaded())
         self.voice_bots = dict()
+        # Serve voice channels by worker processes instead of this one
+        workers = int(os.getenv('VOICE_WORKERS', 0))
+        self.coordinator = workers and Coordinator(DiscordTransport(token), workers)
+        self.log_handler = None
 
     async def on_ready(self):
         logger.info(f"Logged in as {self.user}")
-        channels = {channel.name: channel for channel in self.get_all_channels()}
-        handler = DiscordHandler(channels['boss-only'])
-        handler.setLevel(logging.INFO)
-        formatter = logging.Formatter('%(name)s: %(message)s')
-        handler.setFormatter(formatter)
-        for logger_name in ['discord', 'cities', 'akinator', 'googlesearch', 'parlai', 'youtubedl']:
-            logging.getLogger(logger_name).addHandler(handler)
+        if self.log_handler is None:
+            # Once, on_ready fires again after every reconnect
+            channels = {channel.name: channel for channel in self.get_all_channels()}
+            self.log_handler = DiscordHandler(channels['boss-only'])
+            self.log_handler.setLevel(logging.INFO)
+            formatter = logging.Formatter('%(name)s: %(message)s')
+            self.log_handler.setFormatter(formatter)
+            for logger_name in ['discord', 'cities', 'akinator', 'googlesearch', 'parlai', 'youtubedl']:
+                logging.getLogger(logger_name).addHandler(self.log_handler)
         logger.info(f"Guilds: {self.guilds}")
+        # on_ready fires again after every reconnect: workers and voice connections are kept
+        if self.coordinator:
+            if self.coordinator.task is None:
+                self.coordinator.start()
+        else:
+            # Workers load the voice engines themselves, this process only needs them without workers
+            from voice import DemultiplexerSink, WARMUP_PHRASES, text_to_speech
+            await sync_to_async(clients.warm_up)
+            asyncio.create_task(tts_cache.warm_up(text_to_speech, WARMUP_PHRASES))
         for guild in self.guilds:
             logger.info(f"{guild.name} channels: {guild.channels}")
             logger.info(f"{guild.name} voice channels: {guild.voice_channels}")
             voice_channel = discord.utils.get(guild.voice_channels)
+            if self.coordinator:
+                if voice_channel.id not in self.coordinator:
+                    self.coordinator.assign(voice_channel.id)
+                continue
+            if voice_channel in self.voice_bots:
+                continue
             voice_client = await voice_channel.connect()
             voice_bot = DemultiplexerSink(voice_client, [
                 'bumblebee',
@@ -159,6 +336,12 @@ class OrginizerBot(commands.bot.BotBase, Client):
             await voice_bot.start()
             self.voice_bots[voice_channel] = voice_bot
 
+    async def close(self):
+        if self.coordinator:
+            await self.coordinator.close()
+        await clients.close()
+        await super().close()
+
     async def on_guild_join(self, guild):
         logger.debug(f"{self!r} joined {guild}")
 
@@ -167,7 +350,16 @@ class OrginizerBot(commands.bot.BotBase, Client):
 
     async def on_voice_state_update(self, user, old_state, new_state):
         """ Вызывается, когда пользователь заходит на канал, включает / отключает звук или микрофон """
+        if user != self.user and old_state.channel is not None and old_state.channel != new_state.channel:
+            # Free the resources of the user left
+            if self.coordinator:
+                self.coordinator.goodbye(old_state.channel.id, user.id)
+            elif old_state.channel in self.voice_bots:
+                await self.voice_bots[old_state.channel].on_leave(user)
         if user != self.user and old_state.channel is None and new_state.channel is not None:
+            if self.coordinator:
+                self.coordinator.welcome(new_state.channel.id, user.id)
+                return
             await self.voice_bots[new_state.channel].on_welcome(user)
 
 
@@ -209,17 +401,101 @@ class DialogflowCog(commands.Cog):
 
 
 class DiscordHandler(logging.Handler):
-    def __init__(self, channel):
+    """
+    Ships log records to a Discord channel in the background, so that logging never waits for Discord.
+
+    Records are queued and sent every `interval` seconds as one message (split at Discord's length limit).
+    Speech attached to records is encoded in a thread, at most `max_files` per batch, the latest ones.
+    When `max_pending` records are waiting new ones are dropped, except warnings and errors
+    which push out the oldest record instead.
+    """
+    max_length = 2000 - len('``````')
+    max_files = 10
+
+    def __init__(self, channel, interval=2.0, max_pending=200):
         super().__init__()
         self.channel = channel
-        self.loop = asyncio.get_running_loop()
+        self.interval = interval
+        self.max_pending = max_pending
+        # `deque` appends are thread-safe, so records may come from any thread
+        self.queue = deque()
+        self.peak_depth = 0
+        self.batches = 0
+        self.sent = 0
+        self.dropped = 0
+        self.unreported = 0
+        self.task = asyncio.get_running_loop().create_task(self.ship())
+
+    def __repr__(self):
+        return (
+            f'<{type(self).__name__}>[depth={len(self.queue)} peak_depth={self.peak_depth} '
+            f'batches={self.batches} sent={self.sent} dropped={self.dropped}]'
+        )
 
-    async def send_message(self, speech: Audio, message: str):
-        await self.channel.send(f'```{message}```', file=speech and File(fp=speech.to_wav(), filename='speech.wav'))
+    @property
+    def depth(self) -> int:
+        return len(self.queue)
 
     def emit(self, record: logging.LogRecord):
-        asyncio.run_coroutine_threadsafe(
-            self.send_message(getattr(record, 'speech', None), self.format(record)), self.loop)
+        try:
+            entry = (self.format(record), getattr(record, 'speech', None))
+        except Exception:
+            self.handleError(record)
+            return
+        if len(self.queue) >= self.max_pending:
+            if record.levelno < logging.WARNING:
+                self.dropped += 1
+                self.unreported += 1
+                return
+            with suppress(IndexError):
+                self.queue.popleft()
+                self.dropped += 1
+                self.unreported += 1
+        self.queue.append(entry)
+        self.peak_depth = max(self.peak_depth, len(self.queue))
+
+    async def ship(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self.queue:
+                continue
+            try:
+                await self.send_batch()
+            except Exception as exc:
+                logger.warning(f"{self!r} can't send logs to {self.channel}: {exc}")
+
+    async def send_batch(self):
+        entries = [self.queue.popleft() for _ in range(len(self.queue))]
+        lines = [message[:self.max_length] for message, _ in entries]
+        if self.unreported:
+            lines.append(f'... {self.unreported} records dropped')
+            self.unreported = 0
+        speeches = [speech for _, speech in entries if speech is not None][-self.max_files:]
+        files = await sync_to_async(self.encode_speeches, speeches)
+        messages, current, size = [], [], 0
+        for line in lines:
+            if current and size + len(line) + 1 > self.max_length:
+                messages.append('\n'.join(current))
+                current, size = [], 0
+            current.append(line)
+            size += len(line) + 1
+        messages.append('\n'.join(current))
+        for i, message in enumerate(messages):
+            last = i == len(messages) - 1
+            await self.channel.send(f'```{message}```', files=files if last and files else None)
+        self.batches += 1
+        self.sent += len(entries)
+        logger.debug(f"{self!r} sent {len(entries)} records in {len(messages)} messages")
+
+    @staticmethod
+    def encode_speeches(speeches: List[Audio]) -> List[File]:
+        if ogg.can_encode():
+            return [File(fp=io.BytesIO(ogg.encode_ogg_opus(speech)), filename='speech.ogg') for speech in speeches]
+        return [File(fp=speech.to_mono().to_rate(16000).to_wav(), filename='speech.wav') for speech in speeches]
+
+    def close(self):
+        self.task.cancel()
+        super().close()
 
 
 def setup_logging():
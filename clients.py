@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import contextmanager, asynccontextmanager
+from functools import partial
+
+import aiohttp
+import google.auth
+import google.auth.transport.requests
+from google.cloud import texttospeech, speech_v1p1beta1, translate_v2
+
+logger = logging.getLogger(__name__)
+GOOGLE_SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+# Concurrent requests and deadline in seconds per provider
+PROVIDER_LIMITS = dict(
+    dialogflow=(8, 10),
+    google_tts=(4, 10),
+    google_stt=(4, 15),
+    yandex=(8, 10),
+)
+
+
+class ClientRegistry:
+    """
+    Cloud clients created lazily once per process.
+
+    Reusing clients keeps gRPC channels and HTTP keep-alive connections warm,
+    so TLS handshakes and channel setup are not on the critical path of every voice turn.
+    """
+    factories = dict(
+        tts=texttospeech.TextToSpeechClient,
+        speech=speech_v1p1beta1.SpeechClient,
+        translate=translate_v2.Client,
+    )
+    # Google streaming STT is the only gRPC call of a voice turn
+    hot = ('speech',)
+
+    def __init__(self, keepalive_timeout=60, limit=32):
+        self.keepalive_timeout = keepalive_timeout
+        self.limit = limit
+        self.clients = {}
+        self.session = None
+        self.providers = {}
+        self.credentials = None
+        self.credentials_lock = None
+
+    def __repr__(self):
+        return f'<{type(self).__name__}>[{", ".join(self.clients)}]'
+
+    def get(self, name: str):
+        if name not in self.clients:
+            with timed(f'Creating {name} client'):
+                self.clients[name] = self.factories[name]()
+        return self.clients[name]
+
+    @property
+    def tts(self) -> texttospeech.TextToSpeechClient:
+        return self.get('tts')
+
+    @property
+    def speech(self) -> speech_v1p1beta1.SpeechClient:
+        return self.get('speech')
+
+    @property
+    def translate(self) -> translate_v2.Client:
+        return self.get('translate')
+
+    def http(self) -> aiohttp.ClientSession:
+        """Shared HTTP session with keep-alive connections, must be called from the event loop"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=self.keepalive_timeout)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    def provider(self, name: str) -> 'Provider':
+        if name not in self.providers:
+            concurrency, timeout = PROVIDER_LIMITS[name]
+            self.providers[name] = Provider(
+                name,
+                concurrency=int(os.getenv(f'{name.upper()}_CONCURRENCY', concurrency)),
+                timeout=float(os.getenv(f'{name.upper()}_TIMEOUT', timeout)),
+            )
+        return self.providers[name]
+
+    async def google_headers(self) -> dict:
+        """Authorization headers for Google REST APIs, refreshing the token off the loop when needed"""
+        if self.credentials_lock is None:
+            self.credentials_lock = asyncio.Lock()
+        async with self.credentials_lock:
+            if self.credentials is None:
+                self.credentials, _ = google.auth.default(scopes=GOOGLE_SCOPES)
+            if not self.credentials.valid:
+                request = google.auth.transport.requests.Request()
+                await asyncio.get_running_loop().run_in_executor(None, partial(self.credentials.refresh, request))
+        return {'Authorization': f'Bearer {self.credentials.token}'}
+
+    def warm_up(self):
+        """Create clients of the voice hot path in advance (blocking), the rest go over REST or are rarely used"""
+        for name in self.hot:
+            self.get(name)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        for name, client in self.clients.items():
+            try:
+                close_client(client)
+            except Exception as exc:
+                logger.warning(f"Can't close {name} client: {exc}")
+        self.clients = {}
+        logger.info(f"Closed {self!r}")
+
+
+class Provider:
+    """
+    Concurrency limit and deadline of a cloud API.
+
+    Requests are plain coroutines, so cancelling the caller
+    (e.g. by `DemultiplexerSink.run_interruptible`) aborts the request in flight.
+    """
+    def __init__(self, name: str, concurrency: int, timeout: float):
+        self.name = name
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.in_flight = 0
+
+    def __repr__(self):
+        return f'<{type(self).__name__}>[{self.name} in_flight={self.in_flight} timeout={self.timeout}s]'
+
+    @asynccontextmanager
+    async def limit(self):
+        """Wait for a free slot and yield the request deadline"""
+        async with self.semaphore:
+            self.in_flight += 1
+            try:
+                with timed(self.name):
+                    yield aiohttp.ClientTimeout(total=self.timeout)
+            finally:
+                self.in_flight -= 1
+
+
+def close_client(client):
+    transport = getattr(client, 'transport', None)
+    if hasattr(transport, 'close'):
+        transport.close()
+    elif hasattr(transport, 'channel'):
+        transport.channel.close()
+    elif hasattr(client, '_http'):
+        # HTTP clients like translate_v2.Client keep a requests session
+        client._http.close()
+
+
+@contextmanager
+def timed(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        logger.debug(f"{name} took {(time.perf_counter() - start) * 1000:.1f}ms")
+
+
+clients = ClientRegistry()
@@ -1,22 +1,29 @@
+import asyncio
+import base64
 import importlib
 import logging
 import os
+import queue
 from dataclasses import dataclass
-from typing import Dict, List
+from typing import Any, AsyncIterator, Dict, List
+from urllib.parse import quote
 
 import pkg_resources
 importlib.reload(pkg_resources)  # HACK: https://github.com/googleapis/google-api-python-client/issues/476#issuecomment-371797043
-from dialogflow_v2 import SessionsClient, ContextsClient
-from dialogflow_v2.types import (
-    QueryInput, TextInput, EventInput, InputAudioConfig, QueryParameters, Context, DetectIntentResponse,
-)
 from discord import Member
-from google.cloud import texttospeech, speech_v1p1beta1, translate_v2
-from google.protobuf.struct_pb2 import Struct
+from google.cloud import texttospeech, speech_v1p1beta1
 
-from utils import sync_to_async, contexts_var, Audio, language, EmptyUtterance
+import ogg
+from clients import clients
+from tts_cache import cache as tts_cache
+from utils import (
+    sync_to_async, contexts_var, Audio, language, EmptyUtterance, Transcript, ordered_concurrently, split_sentences,
+)
 
 logger = logging.getLogger(__name__)
+TTS_VOICE = 'ru-RU-Wavenet-C'
+TTS_RATE = 48000
+STT_URL = os.getenv('GOOGLE_STT_URL', 'https://speech.googleapis.com/v1p1beta1/speech:recognize')
 
 
 def get_lang():
@@ -24,140 +31,212 @@ def get_lang():
     return 'ru_RU'
 
 
+async def request_google(url: str, provider: str, payload: dict) -> dict:
+    async with clients.provider(provider).limit() as timeout:
+        headers = await clients.google_headers()
+        async with clients.http().post(url, json=payload, headers=headers, timeout=timeout) as response:
+            body = await response.json(content_type=None)
+            if response.status >= 400:
+                logger.error(f"Unexpected response from {url}: {response.status} ({body})")
+            response.raise_for_status()
+            return body
+
+
+@tts_cache.cached('google', voice=TTS_VOICE, rate=TTS_RATE)
 async def text_to_speech(text) -> Audio:
-    voice = texttospeech.VoiceSelectionParams(
-        ssml_gender=texttospeech.SsmlVoiceGender.FEMALE,
-        # language_code='en-US',
-        # name='en-IN-Wavenet-B',
-        language_code='ru-RU',
-        name='ru-RU-Wavenet-C',
-    )
-    client = texttospeech.TextToSpeechClient()
-    synthesis_input = texttospeech.SynthesisInput(text=text)
-    rate = 48000
-    audio_config = texttospeech.AudioConfig(
-        audio_encoding=texttospeech.AudioEncoding.LINEAR16,
-        sample_rate_hertz=rate,
-    )
-    response = await sync_to_async(
-        client.synthesize_speech, input=synthesis_input, voice=voice, audio_config=audio_config,
-    )
-    result = Audio.from_wav(response.audio_content)
+    response = await request_google('https://texttospeech.googleapis.com/v1/text:synthesize', 'google_tts', dict(
+        input=dict(text=text),
+        voice=dict(
+            ssml_gender='FEMALE',
+            # language_code='en-US',
+            # name='en-IN-Wavenet-B',
+            language_code='ru-RU',
+            name=TTS_VOICE,
+        ),
+        audio_config=dict(audio_encoding='LINEAR16', sample_rate_hertz=TTS_RATE),
+    ))
+    result = Audio.from_wav(base64.b64decode(response['audioContent']))
     logger.debug(f"TTS: {text} -> {result}")
     return result
 
 
-async def speech_to_text(audio: Audio):
-    client = speech_v1p1beta1.SpeechClient()
-
-    # TODO: replace with AUDIO_ENCODING_OGG_OPUS
-    encoding = speech_v1p1beta1.types.RecognitionConfig.AudioEncoding.LINEAR16
-    config = dict(
-        language_code=get_lang(),
-        sample_rate_hertz=audio.rate,
-        encoding=encoding,
-    )
-    audio = dict(content=audio.to_mono().data)
+async def text_to_speech_stream(text, parallelism=3) -> AsyncIterator[Audio]:
+    """Synthesize sentences concurrently and yield them in order as soon as each one is ready"""
+    sentences = split_sentences(text)
+    async for audio in ordered_concurrently((text_to_speech(sentence) for sentence in sentences), parallelism):
+        yield audio
 
-    response = await sync_to_async(client.recognize, config=config, audio=audio)
-    if not response.results:
+
+async def speech_to_text(audio: Audio):
+    if ogg.can_encode():
+        content = await sync_to_async(ogg.encode_ogg_opus, audio)
+        config = dict(encoding='OGG_OPUS', sample_rate_hertz=ogg.SpeechEncoder.SAMPLING_RATE)
+    else:
+        content = audio.to_mono().data
+        config = dict(encoding='LINEAR16', sample_rate_hertz=audio.rate)
+    response = await request_google(STT_URL, 'google_stt', dict(
+        config=dict(language_code=get_lang(), **config),
+        audio=dict(content=base64.b64encode(content).decode()),
+    ))
+    if not response.get('results'):
         raise EmptyUtterance
-    transcript = response.results[0].alternatives[0].transcript
+    transcript = response['results'][0]['alternatives'][0]['transcript']
     logger.info(f"STT: {response} {transcript}")
     return transcript
 
 
+async def streaming_speech_to_text(chunks: AsyncIterator[Audio]) -> AsyncIterator[Transcript]:
+    """Recognize mono `chunks` while they arrive, yielding interim and final transcripts"""
+    chunks = chunks.__aiter__()
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        # Do not open a stream without audio
+        return
+    client = clients.speech
+    types = speech_v1p1beta1.types
+    config = types.StreamingRecognitionConfig(
+        config=types.RecognitionConfig(
+            encoding=types.RecognitionConfig.AudioEncoding.LINEAR16,
+            sample_rate_hertz=first.rate,
+            language_code=get_lang(),
+        ),
+        interim_results=True,
+    )
+    loop = asyncio.get_running_loop()
+    requests = queue.Queue()
+    requests.put(types.StreamingRecognizeRequest(audio_content=bytes(first.data)))
+    results = asyncio.Queue()
+    calls = []
+
+    def recognize():
+        # gRPC streaming is blocking: consume requests and publish results from a worker thread
+        try:
+            calls.append(client.streaming_recognize(config, iter(requests.get, None)))
+            for response in calls[0]:
+                for result in response.results:
+                    transcript = Transcript(text=result.alternatives[0].transcript, is_final=result.is_final)
+                    loop.call_soon_threadsafe(results.put_nowait, transcript)
+        except Exception as exc:
+            loop.call_soon_threadsafe(results.put_nowait, exc)
+        finally:
+            loop.call_soon_threadsafe(results.put_nowait, None)
+
+    async def send():
+        try:
+            async for chunk in chunks:
+                requests.put(types.StreamingRecognizeRequest(audio_content=bytes(chunk.data)))
+        finally:
+            requests.put(None)
+
+    async with clients.provider('google_stt').limit():
+        sender = asyncio.create_task(send())
+        recognizer = asyncio.ensure_future(sync_to_async(recognize))
+        try:
+            while True:
+                result = await results.get()
+                if result is None:
+                    break
+                elif isinstance(result, Exception):
+                    raise result
+                logger.debug(f"STT stream: {result}")
+                yield result
+        finally:
+            sender.cancel()
+            requests.put(None)
+            for call in calls:
+                # Stop the stream on the server too
+                call.cancel()
+            await asyncio.gather(sender, recognizer, return_exceptions=True)
+
+
 @dataclass
 class Intent:
     query_text: str
     text: str
-    parameters: Dict[str, str]
+    parameters: Dict[str, Any]
     action: str
     name: str
     all_required_params_present: bool
     output_contexts: List[str]
     input_contexts: List[str]
-    response: DetectIntentResponse = None
-
-
-def make_parameters(params: dict):
-    parameters = Struct()
-    parameters.update(params)
-    return parameters
+    response: dict = None
 
 
 async def detect_intent(
     user: Member, text: str = None, speech: Audio = None, event: str = None, params: dict = None,
 ) -> Intent:
     dialogflow_project_id = os.getenv('DIALOGFLOW_PROJECT')
-    client = SessionsClient()
-    contexts_client = ContextsClient()
-    session = client.session_path(dialogflow_project_id, user)
+    session = f'projects/{dialogflow_project_id}/agent/sessions/{user}'
     logger.debug(f"Session: {session}")
-    kwargs = {}
+    payload = {}
     if text:
-        query_input = QueryInput(text=TextInput(text=text, language_code=get_lang()))
+        query_input = dict(text=dict(text=text, language_code=get_lang()))
     elif speech:
-        query_input = QueryInput(audio_config=InputAudioConfig(
-            audio_encoding=client.enums.AudioEncoding.AUDIO_ENCODING_LINEAR_16,
-            sample_rate_hertz=speech.rate,
-            language_code=get_lang(),
-            enable_word_info=True,
-        ))
-        kwargs = dict(input_audio=speech.to_mono().data)
+        if ogg.can_encode():
+            content = await sync_to_async(ogg.encode_ogg_opus, speech)
+            audio_config = dict(
+                audio_encoding='AUDIO_ENCODING_OGG_OPUS', sample_rate_hertz=ogg.SpeechEncoder.SAMPLING_RATE,
+            )
+        else:
+            content = speech.to_mono().data
+            audio_config = dict(audio_encoding='AUDIO_ENCODING_LINEAR_16', sample_rate_hertz=speech.rate)
+        query_input = dict(audio_config=dict(**audio_config, language_code=get_lang(), enable_word_info=True))
+        payload = dict(input_audio=base64.b64encode(content).decode())
     elif event:
-        query_input = QueryInput(event=EventInput(name=event, parameters=make_parameters(params), language_code=get_lang()))
+        query_input = dict(event=dict(name=event, parameters=params or {}, language_code=get_lang()))
     else:
         raise ValueError("One of `text`, `speech` or `event` should be set")
 
-    query_params = QueryParameters(
+    query_params = dict(
         contexts=[
-            Context(name=contexts_client.context_path(dialogflow_project_id, user, context), lifespan_count=1)
+            dict(name=f'{session}/contexts/{context}', lifespan_count=1)
             for context in contexts_var.get()
         ],
         reset_contexts=True,
     )
 
-    response = await sync_to_async(
-        client.detect_intent,
-        session=session,
+    url = f'https://dialogflow.googleapis.com/v2/{quote(session, safe="/")}:detectIntent'
+    response = await request_google(url, 'dialogflow', dict(
         query_input=query_input,
         query_params=query_params,
-        **kwargs,
-    )
+        **payload,
+    ))
+    query_result = response['queryResult']
     intent = Intent(
-        text=response.query_result.fulfillment_text,
-        parameters={field_name: field.string_value for field_name, field in response.query_result.parameters.fields.items()},
-        action=response.query_result.action,
-        all_required_params_present=response.query_result.all_required_params_present,
-        query_text=response.query_result.query_text,
-        name=response.query_result.intent.name,
-        output_contexts=[c.name for c in response.query_result.output_contexts],
+        text=query_result.get('fulfillmentText', ''),
+        parameters=query_result.get('parameters', {}),
+        action=query_result.get('action', ''),
+        all_required_params_present=query_result.get('allRequiredParamsPresent', False),
+        query_text=query_result.get('queryText', ''),
+        name=query_result.get('intent', {}).get('name', ''),
+        output_contexts=[c['name'] for c in query_result.get('outputContexts', [])],
         input_contexts=contexts_var.get(),
+        response=response,
     )
     logger.info(f"Detected intent: {intent}")
     return intent
 
 
 async def translate(source: str, target: str, text: str):
-    translate_client = translate_v2.Client()
+    translate_client = clients.translate
     result = await sync_to_async(translate_client.translate, text, source_language=source, target_language=target)
     translated = result['translatedText']
     logger.debug(f"Translated: '{text}' -> '{translated}'")
     return translated
 
 
-def text_to_speech(text):
+def text_to_speech_sync(text):
     voice = texttospeech.VoiceSelectionParams(
         ssml_gender=texttospeech.SsmlVoiceGender.FEMALE,
         # language_code='en-US',
         # name='en-IN-Wavenet-B',
         language_code='ru-RU',
-        name='ru-RU-Wavenet-C',
+        name=TTS_VOICE,
     )
-    client = texttospeech.TextToSpeechClient()
+    client = clients.tts
     synthesis_input = texttospeech.SynthesisInput(text=text)
-    rate = 48000
+    rate = TTS_RATE
     audio_config = texttospeech.AudioConfig(
         audio_encoding=texttospeech.AudioEncoding.LINEAR16,
         sample_rate_hertz=rate,
@@ -169,4 +248,4 @@ def text_to_speech(text):
 
 
 if __name__ == '__main__':
-    text_to_speech('Hello, World!')
+    text_to_speech_sync('Hello, World!')
@@ -0,0 +1,140 @@
+import logging
+import os
+import re
+from dataclasses import replace
+from typing import Dict, Iterable, Optional, Tuple
+
+from cachetools import TTLCache
+
+import google_cloud
+from google_cloud import Intent
+from utils import contexts_var, language
+
+logger = logging.getLogger(__name__)
+# Short answers resolved without Dialogflow: context -> language -> action -> phrases.
+# Phrases are only matched while their context is active, that is while `ask_and_detect_intent` waits for an answer
+REPEAT = dict(
+    ru=['повтори', 'повтори пожалуйста', 'еще раз', 'что', 'что что', 'не расслышал'],
+    en=['repeat', 'repeat please', 'again', 'what', 'pardon', 'say again'],
+)
+PHRASES = {
+    'yes-no': dict(
+        ru=dict(
+            yes=['да', 'ага', 'угу', 'конечно', 'давай', 'да да', 'хорошо', 'ладно', 'можно'],
+            no=['нет', 'не', 'неа', 'не надо', 'нет нет', 'не хочу', 'ни за что'],
+            repeat=REPEAT['ru'],
+        ),
+        en=dict(
+            yes=['yes', 'yeah', 'yep', 'sure', 'of course', 'ok', 'okay'],
+            no=['no', 'nope', 'nah', 'no way', 'not really'],
+            repeat=REPEAT['en'],
+        ),
+    ),
+}
+PUNCTUATION = re.compile(r'[^\w\s]+')
+SPACES = re.compile(r'\s+')
+
+
+def normalize(text: str) -> str:
+    text = PUNCTUATION.sub(' ', text.lower().replace('ё', 'е'))
+    return SPACES.sub(' ', text).strip()
+
+
+class PhraseIndex:
+    """Exact match of normalized phrases to actions, compiled once per set of active contexts and language"""
+    def __init__(self, phrases=PHRASES):
+        self.phrases = phrases
+        self.compiled = {}
+
+    def compile(self, contexts: Tuple[str, ...], lang: str) -> Dict[str, str]:
+        key = (contexts, lang)
+        if key not in self.compiled:
+            index = {}
+            for context in contexts:
+                for action, phrases in self.phrases.get(context, {}).get(lang, {}).items():
+                    index.update((normalize(phrase), action) for phrase in phrases)
+            self.compiled[key] = index
+        return self.compiled[key]
+
+    def match(self, text: str, contexts: Iterable[str], lang: str) -> Optional[str]:
+        return self.compile(tuple(sorted(contexts)), lang).get(normalize(text))
+
+
+class IntentResolver:
+    """
+    Text intent detection with local fast path.
+
+    Short utterances are matched against `PhraseIndex` first, then the TTL cache
+    of context-free Dialogflow results is checked and only then Dialogflow is queried.
+    """
+    def __init__(self, index: PhraseIndex, maxsize=1024, ttl=300):
+        self.index = index
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.local_hits = 0
+        self.cache_hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return (
+            f'local_hits={self.local_hits} cache_hits={self.cache_hits} misses={self.misses} '
+            f'hit_ratio={self.hit_ratio:.2f} entries={len(self.cache)}'
+        )
+
+    def __repr__(self):
+        return f'<{type(self).__name__}>[{self}]'
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.local_hits + self.cache_hits + self.misses
+        return (self.local_hits + self.cache_hits) / total if total else 0
+
+    def match(self, text: str) -> Optional[Intent]:
+        contexts = list(contexts_var.get())
+        if not contexts:
+            # Outside of a question the text needs a real answer from Dialogflow
+            return None
+        action = self.index.match(text, contexts, language.get())
+        if action is None:
+            return None
+        return Intent(
+            query_text=text,
+            text='',
+            parameters={},
+            action=action,
+            name=f'local/{action}',
+            all_required_params_present=True,
+            output_contexts=[],
+            input_contexts=contexts,
+        )
+
+    async def detect_intent(self, user, text: str = None, **kwargs) -> Intent:
+        """Same as `google_cloud.detect_intent`, only text queries take the fast path"""
+        if not text:
+            return await google_cloud.detect_intent(user, text, **kwargs)
+        intent = self.match(text)
+        if intent is not None:
+            self.local_hits += 1
+            logger.info(f"Matched intent locally: {intent.action} ({self})")
+            return intent
+        key = (tuple(sorted(contexts_var.get())), language.get(), normalize(text))
+        intent = self.cache.get(key)
+        if intent is not None:
+            self.cache_hits += 1
+            logger.info(f"Cached intent: {intent.action} ({self})")
+            return intent
+        self.misses += 1
+        intent = await google_cloud.detect_intent(user, text, **kwargs)
+        if intent.all_required_params_present and not intent.output_contexts:
+            # The key has no session: intents filling slots or opening contexts belong to their user.
+            # The raw response carries the session too, so it is not shared either
+            self.cache[key] = replace(intent, response=None)
+        logger.debug(f"{self!r}")
+        return intent
+
+
+resolver = IntentResolver(
+    PhraseIndex(),
+    maxsize=int(os.getenv('INTENT_CACHE_SIZE', 1024)),
+    ttl=float(os.getenv('INTENT_CACHE_TTL', 300)),
+)
+detect_intent = resolver.detect_intent
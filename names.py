@@ -0,0 +1,113 @@
+import heapq
+import logging
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from fuzzywuzzy import fuzz
+from fuzzywuzzy.utils import full_process
+
+logger = logging.getLogger(__name__)
+
+
+def trigrams(text: str) -> Set[str]:
+    text = f'  {text} '
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def bigrams(text: str) -> Set[str]:
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+class NameIndex:
+    """
+    Fuzzy lookup of objects by their names.
+
+    Names are split into trigrams with an inverted index from trigram to objects.
+    A query is only scored (with the same `WRatio` as `fuzzywuzzy.process.extractOne`)
+    against `candidates` objects sharing the most trigrams with it, plus the ones tied with the last of them,
+    `max_candidates` at most. Queries shorter than `short` characters may share no trigram with
+    the best match, so their bigrams are counted too.
+    """
+    def __init__(self, candidates=32, max_candidates=128, short=5):
+        self.candidates = candidates
+        self.max_candidates = max_candidates
+        self.short = short
+        self.objects = {}
+        self.names: Dict[object, Tuple[str, ...]] = {}
+        self.postings = defaultdict(set)
+
+    def __repr__(self):
+        return f'<{type(self).__name__}>[objects={len(self.objects)} grams={len(self.postings)}]'
+
+    def __len__(self):
+        return len(self.objects)
+
+    @staticmethod
+    def grams(name: str) -> Set[str]:
+        return trigrams(name) | bigrams(name)
+
+    def add(self, key, obj, names: Iterable[Optional[str]]):
+        """Index `obj` under `names` (None are skipped), replacing names it had before"""
+        self.remove(key)
+        names = tuple({full_process(name) for name in names if name} - {''})
+        self.objects[key] = obj
+        self.names[key] = names
+        for name in names:
+            for gram in self.grams(name):
+                self.postings[gram].add(key)
+
+    def remove(self, key):
+        self.objects.pop(key, None)
+        for name in self.names.pop(key, ()):
+            for gram in self.grams(name):
+                keys = self.postings[gram]
+                keys.discard(key)
+                if not keys:
+                    del self.postings[gram]
+
+    def resolve(self, query: str) -> Tuple[Optional[object], int]:
+        """Return the best matching object and its similarity from 0 to 100"""
+        query = full_process(query)
+        if not query:
+            return None, 0
+        overlap = Counter()
+        for gram in self.grams(query) if len(query) < self.short else trigrams(query):
+            overlap.update(self.postings.get(gram, ()))
+        ranked = heapq.nlargest(self.max_candidates, overlap.items(), key=lambda item: item[1])
+        if len(ranked) > self.candidates:
+            cutoff = ranked[self.candidates - 1][1]
+            ranked = [(key, count) for key, count in ranked if count >= cutoff]
+        best, best_score = None, 0
+        for key, _ in ranked:
+            score = max(fuzz.WRatio(query, name, full_process=False) for name in self.names[key])
+            if score > best_score:
+                best, best_score = key, score
+        return self.objects.get(best), best_score
+
+
+class GuildNames:
+    """
+    Member and voice channel indexes of a guild, kept up to date by `OrginizerCog` event listeners.
+
+    Pass snapshots of `members` and `channels` to build it outside of the event loop.
+    """
+    def __init__(self, guild, members=None, channels=None):
+        self.members = NameIndex()
+        self.channels = NameIndex()
+        for member in guild.members if members is None else members:
+            self.add_member(member)
+        for channel in guild.voice_channels if channels is None else channels:
+            self.add_channel(channel)
+        logger.info(f"Indexed {guild}: {self.members!r} {self.channels!r}")
+
+    def add_member(self, member):
+        self.members.add(member.id, member, [member.name, member.nick])
+
+    def remove_member(self, member):
+        self.members.remove(member.id)
+
+    def add_channel(self, channel):
+        self.channels.add(channel.id, channel, [channel.name])
+
+    def remove_channel(self, channel):
+        self.channels.remove(channel.id)
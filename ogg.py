@@ -0,0 +1,188 @@
+"""
+OGG Opus encoding of utterances for STT uploads
+
+    python ogg.py [wav]
+
+checks that an encoded utterance demuxes and decodes back to the input.
+"""
+import logging
+import math
+import os
+import sys
+from array import array
+from struct import Struct
+from typing import Iterator, List, Tuple
+
+from discord.opus import Encoder, Decoder, is_loaded
+
+from utils import Audio
+
+logger = logging.getLogger(__name__)
+# Opus always counts granule positions in 48 kHz samples
+GRANULE_RATE = 48000
+# Encoder lookahead at 48 kHz, decoders skip this many samples
+PRE_SKIP = 312
+PAGE_HEADER = Struct('<4sBBqIIIB')
+OPUS_HEAD = Struct('<8sBBHIhB')
+STT_OPUS = os.getenv('STT_OPUS', '1') == '1'
+
+
+def crc_table() -> List[int]:
+    table = []
+    for byte in range(256):
+        crc = byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+
+CRC_TABLE = crc_table()
+
+
+def ogg_crc(data: bytes) -> int:
+    """CRC-32 of OGG pages: polynomial 0x04C11DB7, not reflected, no final xor"""
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ CRC_TABLE[(crc >> 24) ^ byte]
+    return crc
+
+
+def lacing(packet: bytes) -> List[int]:
+    return [255] * (len(packet) // 255) + [len(packet) % 255]
+
+
+def ogg_page(packets: List[bytes], granule: int, serial: int, sequence: int, flags=0) -> bytes:
+    segments = [size for packet in packets for size in lacing(packet)]
+    header = PAGE_HEADER.pack(b'OggS', 0, flags, granule, serial, sequence, 0, len(segments)) + bytes(segments)
+    page = bytearray(header + b''.join(packets))
+    page[22:26] = ogg_crc(page).to_bytes(4, 'little')
+    return bytes(page)
+
+
+def mux_ogg_opus(packets: List[bytes], channels: int, rate: int, frame_duration=0.02, serial=1) -> bytes:
+    """Put Opus `packets` of `frame_duration` each into an OGG stream"""
+    head = OPUS_HEAD.pack(b'OpusHead', 1, channels, PRE_SKIP, rate, 0, 0)
+    tags = b'OpusTags' + len(b'dindon').to_bytes(4, 'little') + b'dindon' + bytes(4)
+    pages = [ogg_page([head], 0, serial, 0, flags=0x02), ogg_page([tags], 0, serial, 1)]
+    samples_per_packet = int(GRANULE_RATE * frame_duration)
+    granule = PRE_SKIP
+    page_packets = []
+    segments = 0
+    for packet in packets:
+        if segments + len(lacing(packet)) > 255:
+            pages.append(ogg_page(page_packets, granule, serial, len(pages)))
+            page_packets, segments = [], 0
+        page_packets.append(packet)
+        segments += len(lacing(packet))
+        granule += samples_per_packet
+    pages.append(ogg_page(page_packets, granule, serial, len(pages), flags=0x04))
+    return b''.join(pages)
+
+
+def demux_ogg(data: bytes) -> Iterator[Tuple[bytes, int]]:
+    """Yield packets of an OGG stream with granule positions of their pages, checking page CRCs"""
+    offset = 0
+    packet = b''
+    while offset < len(data):
+        magic, version, flags, granule, serial, sequence, crc, count = PAGE_HEADER.unpack_from(data, offset)
+        if magic != b'OggS':
+            raise ValueError(f"No OGG page at {offset}")
+        segments = data[offset + PAGE_HEADER.size:offset + PAGE_HEADER.size + count]
+        end = offset + PAGE_HEADER.size + count + sum(segments)
+        page = bytearray(data[offset:end])
+        page[22:26] = bytes(4)
+        if ogg_crc(page) != crc:
+            raise ValueError(f"Bad CRC of OGG page {sequence}")
+        position = offset + PAGE_HEADER.size + count
+        for size in segments:
+            packet += data[position:position + size]
+            position += size
+            if size < 255:
+                yield packet, granule
+                packet = b''
+        offset = end
+
+
+class SpeechEncoder(Encoder):
+    """Opus encoder of 16 kHz mono speech"""
+    SAMPLING_RATE = 16000
+    CHANNELS = 1
+    FRAME_LENGTH = 20
+    SAMPLES_PER_FRAME = 320
+    FRAME_SIZE = SAMPLES_PER_FRAME * 2
+
+    def __init__(self, bitrate=24):
+        super().__init__()
+        self.set_bitrate(bitrate)
+        self.set_bandwidth('wide')
+        self.set_signal_type('voice')
+
+
+class SpeechDecoder(Decoder):
+    SAMPLING_RATE = 16000
+    CHANNELS = 1
+    FRAME_LENGTH = 20
+    SAMPLES_PER_FRAME = 320
+    FRAME_SIZE = SAMPLES_PER_FRAME * 2
+
+
+def can_encode() -> bool:
+    return STT_OPUS and is_loaded()
+
+
+def encode_ogg_opus(audio: Audio) -> bytes:
+    """Encode speech into OGG Opus, about 10 times smaller than 16 kHz LINEAR16 (blocking)"""
+    audio = audio.to_mono().to_rate(SpeechEncoder.SAMPLING_RATE)
+    encoder = SpeechEncoder()
+    data = bytes(audio.data)
+    if len(data) % SpeechEncoder.FRAME_SIZE:
+        data += bytes(SpeechEncoder.FRAME_SIZE - len(data) % SpeechEncoder.FRAME_SIZE)
+    packets = [
+        encoder.encode(data[offset:offset + SpeechEncoder.FRAME_SIZE], SpeechEncoder.SAMPLES_PER_FRAME)
+        for offset in range(0, len(data), SpeechEncoder.FRAME_SIZE)
+    ]
+    encoded = mux_ogg_opus(packets, SpeechEncoder.CHANNELS, SpeechEncoder.SAMPLING_RATE)
+    logger.debug(f"Encoded {audio.duration:.2f}s: {len(audio.data)} -> {len(encoded)} bytes")
+    return encoded
+
+
+def decode_ogg_opus(data: bytes) -> Audio:
+    """Decode OGG Opus made by `encode_ogg_opus`, with pre-skip removed"""
+    decoder = SpeechDecoder()
+    packets = [packet for packet, _ in demux_ogg(data)]
+    head = OPUS_HEAD.unpack(packets[0])
+    pcm = b''.join(decoder.decode(packet) for packet in packets[2:])
+    pre_skip = head[3] * SpeechDecoder.SAMPLING_RATE // GRANULE_RATE
+    return Audio(channels=SpeechDecoder.CHANNELS, width=2, rate=SpeechDecoder.SAMPLING_RATE, data=pcm[pre_skip * 2:])
+
+
+def main(path=None):
+    if path:
+        audio = Audio.load(path).to_mono().to_rate(SpeechEncoder.SAMPLING_RATE)
+    else:
+        # A second of 440 Hz
+        samples = array('h', (int(10000 * math.sin(2 * math.pi * 440 * i / 16000)) for i in range(16000)))
+        audio = Audio(channels=1, width=2, rate=16000, data=samples.tobytes())
+
+    packets = [os.urandom(size) for size in (1, 254, 255, 256, 510, 1275)] * 50
+    assert [packet for packet, _ in demux_ogg(mux_ogg_opus(packets, 1, 16000))][2:] == packets, "Muxing is lossy"
+
+    encoded = encode_ogg_opus(audio)
+    decoded = decode_ogg_opus(encoded)
+    length = min(len(audio.data), len(decoded.data)) // 2
+    original, restored = array('h', bytes(audio.data))[:length], array('h', bytes(decoded.data))[:length]
+    noise = sum((a - b) ** 2 for a, b in zip(original, restored))
+    signal = sum(a * a for a in original)
+    snr = 10 * math.log10(signal / max(noise, 1))
+    print(f"{audio.duration:.2f}s: {len(audio.data)} bytes PCM -> {len(encoded)} bytes OGG Opus "
+          f"({len(audio.data) / len(encoded):.1f}x), decoded SNR {snr:.1f} dB")
+    assert snr > 10, "Decoded audio does not match the input"
+
+
+if __name__ == '__main__':
+    from ctypes.util import find_library
+    from discord.opus import load_opus
+    if not is_loaded():
+        load_opus(os.getenv('OPUS_LIBRARY') or find_library('opus'))
+    main(*sys.argv[1:])
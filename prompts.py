@@ -0,0 +1,103 @@
+import hashlib
+import logging
+import os
+from dataclasses import dataclass
+from struct import Struct
+from typing import Dict, List, Optional
+
+from discord.opus import Encoder
+
+from utils import Audio
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Prompt:
+    """Static sound encoded once into 20ms Opus packets, ready for `VoiceClient.send_audio_packet(encode=False)`"""
+    name: str
+    audio: Audio
+    packets: List[bytes]
+
+    @property
+    def duration(self) -> float:
+        return len(self.packets) * Encoder.FRAME_LENGTH / 1000
+
+
+class PromptCache:
+    """
+    Opus packets of prompts, in memory of the process and optionally on disk.
+
+    The disk file is named by the hash of the source PCM, packets are stored length-prefixed.
+    """
+    length = Struct('<H')
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory
+        self.prompts: Dict[str, Prompt] = {}
+
+    def __repr__(self):
+        return f'<{type(self).__name__}>[{", ".join(self.prompts)}]'
+
+    def load(self, path: str) -> Prompt:
+        if path not in self.prompts:
+            audio = Audio.load(path).to_stereo().to_rate(Encoder.SAMPLING_RATE)
+            key = hashlib.sha256(bytes(audio.data)).hexdigest()
+            packets = self.load_packets(key)
+            if packets is None:
+                packets = encode_opus(audio)
+                self.save_packets(key, packets)
+            self.prompts[path] = Prompt(name=path, audio=audio, packets=packets)
+            logger.debug(f"Loaded prompt {path}: {len(packets)} packets")
+        return self.prompts[path]
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.opus')
+
+    def load_packets(self, key: str) -> Optional[List[bytes]]:
+        if self.directory is None:
+            return None
+        try:
+            with open(self.get_path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        packets = []
+        offset = 0
+        while offset < len(data):
+            size, = self.length.unpack_from(data, offset)
+            offset += self.length.size
+            packets.append(data[offset:offset + size])
+            offset += size
+        return packets
+
+    def save_packets(self, key: str, packets: List[bytes]):
+        if self.directory is None:
+            return
+        path = self.get_path(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                for packet in packets:
+                    f.write(self.length.pack(len(packet)))
+                    f.write(packet)
+            os.replace(tmp_path, path)
+        except OSError as exc:
+            logger.warning(f"Can't save {path}: {exc}")
+
+
+def encode_opus(audio: Audio) -> List[bytes]:
+    """Encode 48 kHz stereo audio into 20ms Opus packets, the last one is padded with silence"""
+    encoder = Encoder()
+    frame_size = Encoder.SAMPLES_PER_FRAME * audio.channels * audio.width
+    data = bytes(audio.data)
+    if len(data) % frame_size:
+        data += bytes(frame_size - len(data) % frame_size)
+    return [
+        encoder.encode(data[offset:offset + frame_size], Encoder.SAMPLES_PER_FRAME)
+        for offset in range(0, len(data), frame_size)
+    ]
+
+
+prompts = PromptCache(os.getenv('OPUS_CACHE_DIR') or None)
@@ -0,0 +1,370 @@
+"""
+Voice channels served by a pool of worker processes
+
+The coordinator (the bot process) keeps the Discord gateway for text commands and events
+and assigns voice channels to workers. Every worker runs `DemultiplexerSink`s of its channels
+with their STT/TTS/intent pipelines on its own event loop. Synthesized speech is shared
+through the on-disk tier of the TTS cache. Run locally with fake voice sources:
+
+    python shards.py [workers] [channels] [users]
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from collections import namedtuple
+from contextlib import suppress
+from typing import Dict, List, Tuple
+
+from utils import Audio
+
+logger = logging.getLogger(__name__)
+KEYWORDS = ['bumblebee']
+
+
+class DiscordTransport:
+    """
+    Voice connections of a worker made through its own gateway session.
+
+    A bot can be in a single voice channel of a guild, so every guild is served by one worker.
+    """
+    def __init__(self, token: str):
+        self.token = token
+        self.client = None
+
+    async def start(self):
+        import discord
+        if not discord.opus.is_loaded():
+            discord.opus.load_opus(os.getenv('OPUS_LIBRARY', '/usr/local/Cellar/opus/1.3.1/lib/libopus.0.dylib'))
+        self.client = discord.Client()
+        asyncio.create_task(self.client.start(self.token))
+        await self.client.wait_until_ready()
+
+    async def connect(self, channel_id: int):
+        from discord.reader import AudioReader
+        voice_client = await self.client.get_channel(channel_id).connect()
+        return voice_client, AudioReader
+
+    async def disconnect(self, voice_client):
+        await voice_client.disconnect()
+
+    def get_user(self, voice_client, user_id: int):
+        return voice_client.guild.get_member(user_id)
+
+    async def close(self):
+        await self.client.close()
+
+
+FakeUser = namedtuple('FakeUser', ['id', 'name'])
+VoiceData = namedtuple('VoiceData', ['user', 'pcm'])
+
+
+class FakeSpeakingState:
+    async def speak(self, state):
+        pass
+
+
+class FakeVoiceClient:
+    """Stand-in for `VoiceClient` counting sent packets"""
+    def __init__(self, channel_id: int, users: List[FakeUser]):
+        self.channel = f'fake-{channel_id}'
+        self.users = users
+        self.ws = FakeSpeakingState()
+        self.sent = 0
+
+    def send_audio_packet(self, data: bytes, encode=True):
+        self.sent += 1
+
+
+class FakeReader:
+    """Stand-in for `AudioReader`: every user of the channel says `sound` in a loop, 20ms packets in real time"""
+    sound = 'hello.wav'
+
+    def __init__(self, sink, voice_client: FakeVoiceClient):
+        self.client = voice_client
+
+    async def listen_voice(self):
+        audio = Audio.load(self.sound).to_stereo().to_rate(48000)
+        size = 960 * audio.channels * audio.width
+        packets = [audio.data[i:i + size] for i in range(0, len(audio.data) - size + 1, size)]
+        while True:
+            for pcm in packets:
+                await asyncio.sleep(0.02)
+                for user in self.client.users:
+                    yield VoiceData(user, pcm)
+
+
+class FakeTransport:
+    def __init__(self, users=2):
+        self.users = [FakeUser(id=i, name=f'user{i}') for i in range(users)]
+
+    async def start(self):
+        pass
+
+    async def connect(self, channel_id: int):
+        return FakeVoiceClient(channel_id, self.users), FakeReader
+
+    async def disconnect(self, voice_client):
+        pass
+
+    def get_user(self, voice_client, user_id: int):
+        return next(user for user in self.users if user.id == user_id)
+
+    async def close(self):
+        pass
+
+
+def run_worker(index: int, connection, transport):
+    """Worker process entry point"""
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)-15s %(levelname)s[worker{index}] %(message)s')
+    asyncio.run(Worker(index, connection, transport).run())
+
+
+class Worker:
+    """
+    Runs voice channels assigned by `Coordinator`, commands come through `connection`.
+
+    Every channel has its own queue and task, so a long welcome in one channel
+    does not hold commands of the others: the main loop only dispatches.
+    """
+    def __init__(self, index: int, connection, transport):
+        self.index = index
+        self.connection = connection
+        self.transport = transport
+        self.sinks = {}
+        self.channels: Dict[int, Tuple[asyncio.Queue, asyncio.Task]] = {}
+        self.commands = asyncio.Queue()
+
+    def __repr__(self):
+        return f'<{type(self).__name__}>[{self.index} channels={list(self.sinks)}]'
+
+    async def run(self):
+        # Imported here, so that the coordinator does not load voice engines
+        from voice import WARMUP_PHRASES, text_to_speech
+        from tts_cache import cache as tts_cache
+
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.connection.fileno(), self.on_readable)
+        await self.transport.start()
+        asyncio.create_task(tts_cache.warm_up(text_to_speech, WARMUP_PHRASES))
+        while True:
+            command, *args = await self.commands.get()
+            if command == 'stop':
+                break
+            channel_id = args[0]
+            if channel_id not in self.channels:
+                queue = asyncio.Queue()
+                self.channels[channel_id] = (queue, asyncio.create_task(self.serve(channel_id, queue)))
+            self.channels[channel_id][0].put_nowait((command, *args))
+        for queue, task in self.channels.values():
+            task.cancel()
+        await asyncio.gather(*(task for _, task in self.channels.values()), return_exceptions=True)
+        for voice_client, sink in self.sinks.values():
+            await sink.cleanup()
+            await self.transport.disconnect(voice_client)
+        await self.transport.close()
+
+    async def serve(self, channel_id: int, queue: asyncio.Queue):
+        """Run commands of a channel in order"""
+        from voice import DemultiplexerSink
+
+        while True:
+            command, *args = await queue.get()
+            try:
+                if command == 'join':
+                    voice_client, reader_factory = await self.transport.connect(channel_id)
+                    sink = DemultiplexerSink(voice_client, KEYWORDS, reader_factory=reader_factory)
+                    self.sinks[channel_id] = (voice_client, sink)
+                    await sink.start()
+                elif command == 'leave':
+                    voice_client, sink = self.sinks.pop(channel_id)
+                    await sink.cleanup()
+                    await self.transport.disconnect(voice_client)
+                    if queue.empty():
+                        del self.channels[channel_id]
+                        return
+                elif command == 'welcome':
+                    _, user_id = args
+                    voice_client, sink = self.sinks[channel_id]
+                    await sink.on_welcome(self.transport.get_user(voice_client, user_id))
+                elif command == 'goodbye':
+                    _, user_id = args
+                    voice_client, sink = self.sinks[channel_id]
+                    await sink.on_leave(self.transport.get_user(voice_client, user_id))
+                logger.info(f"{self!r} {command} {args}")
+            except Exception as exc:
+                logger.exception(f"{self!r} can't {command} {args}: {exc}")
+
+    def on_readable(self):
+        try:
+            self.commands.put_nowait(self.connection.recv())
+        except EOFError:
+            # Coordinator is gone
+            asyncio.get_running_loop().remove_reader(self.connection.fileno())
+            self.commands.put_nowait(('stop',))
+
+
+class Coordinator:
+    """
+    Assigns voice channels to `workers` processes, the least loaded one first.
+
+    Dead workers are restarted after an exponential backoff and their channels are assigned again.
+    Every spawn opens a gateway session, so a worker index failing `max_restarts` times in a row
+    (e.g. with a bad token) is given up on and its channels go to the other workers.
+    A worker alive for `stable_after` seconds is considered healthy again.
+    """
+    def __init__(self, transport, workers=2, check_interval=1.0, max_restarts=5, backoff=2.0, max_backoff=300.0,
+                 stable_after=60.0):
+        self.transport = transport
+        self.check_interval = check_interval
+        self.max_restarts = max_restarts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.context = multiprocessing.get_context('spawn')
+        self.processes = [None] * workers
+        self.connections = [None] * workers
+        self.started = [0.0] * workers
+        self.failures = [0] * workers
+        self.retry_at: Dict[int, float] = {}
+        self.stopped = set()
+        self.assignments: Dict[int, int] = {}
+        # Channels waiting for any worker to come back
+        self.unassigned = set()
+        self.restarts = 0
+        self.task = None
+
+    def __repr__(self):
+        load = [self.load(index) for index in range(len(self.processes))]
+        return (
+            f'<{type(self).__name__}>[load={load} restarts={self.restarts} '
+            f'waiting={sorted(self.retry_at)} stopped={sorted(self.stopped)} unassigned={len(self.unassigned)}]'
+        )
+
+    def __contains__(self, channel_id: int) -> bool:
+        """Whether the channel is assigned to a worker or waits for one"""
+        return channel_id in self.assignments or channel_id in self.unassigned
+
+    def load(self, index: int) -> int:
+        return sum(worker == index for worker in self.assignments.values())
+
+    def start(self):
+        for index in range(len(self.processes)):
+            self.spawn(index)
+        self.task = asyncio.create_task(self.supervise())
+
+    def spawn(self, index: int):
+        connection, child_connection = self.context.Pipe()
+        process = self.context.Process(
+            target=run_worker, args=(index, child_connection, self.transport), name=f'voice-worker-{index}', daemon=True)
+        process.start()
+        self.processes[index] = process
+        self.connections[index] = connection
+        self.started[index] = time.monotonic()
+
+    def send(self, channel_id: int, *command):
+        try:
+            self.connections[self.assignments[channel_id]].send(command)
+        except OSError as exc:
+            # The channel is assigned again once the worker is restarted
+            logger.warning(f"Can't send {command} to worker {self.assignments[channel_id]}: {exc}")
+
+    def assign(self, channel_id: int):
+        available = [
+            index for index in range(len(self.processes)) if index not in self.stopped and index not in self.retry_at
+        ]
+        if not available:
+            self.unassigned.add(channel_id)
+            logger.error(f"No voice workers for channel {channel_id}: {self!r}")
+            return
+        self.unassigned.discard(channel_id)
+        index = min(available, key=self.load)
+        self.assignments[channel_id] = index
+        self.send(channel_id, 'join', channel_id)
+        logger.info(f"Assigned channel {channel_id} to worker {index}: {self!r}")
+
+    def release(self, channel_id: int):
+        self.unassigned.discard(channel_id)
+        if channel_id in self.assignments:
+            self.send(channel_id, 'leave', channel_id)
+            del self.assignments[channel_id]
+
+    def welcome(self, channel_id: int, user_id: int):
+        if channel_id in self.assignments:
+            self.send(channel_id, 'welcome', channel_id, user_id)
+
+    def goodbye(self, channel_id: int, user_id: int):
+        if channel_id in self.assignments:
+            self.send(channel_id, 'goodbye', channel_id, user_id)
+
+    async def supervise(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            now = time.monotonic()
+            for index, process in enumerate(self.processes):
+                if index in self.stopped:
+                    continue
+                if index in self.retry_at:
+                    if now >= self.retry_at[index]:
+                        del self.retry_at[index]
+                        self.restarts += 1
+                        self.spawn(index)
+                        logger.info(f"Restarted worker {index}: {self!r}")
+                        for channel_id in list(self.unassigned):
+                            self.assign(channel_id)
+                    continue
+                if process.is_alive():
+                    if self.failures[index] and now - self.started[index] >= self.stable_after:
+                        self.failures[index] = 0
+                    continue
+                self.failures[index] += 1
+                orphans = [channel_id for channel_id, worker in self.assignments.items() if worker == index]
+                for channel_id in orphans:
+                    del self.assignments[channel_id]
+                if self.failures[index] > self.max_restarts:
+                    self.stopped.add(index)
+                    logger.error(
+                        f"Worker {index} died with exit code {process.exitcode} {self.failures[index]} times in a row, "
+                        f"giving up on it: {self!r}"
+                    )
+                else:
+                    delay = min(self.backoff * 2 ** (self.failures[index] - 1), self.max_backoff)
+                    self.retry_at[index] = now + delay
+                    logger.warning(f"Worker {index} died with exit code {process.exitcode}, restarting in {delay:.0f}s")
+                # Channels are not left without voice while their worker waits
+                for channel_id in orphans:
+                    self.assign(channel_id)
+
+    async def close(self, timeout=5.0):
+        if self.task is not None:
+            self.task.cancel()
+        for connection in self.connections:
+            with suppress(OSError):
+                connection.send(('stop',))
+        for process in self.processes:
+            await asyncio.get_running_loop().run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                process.terminate()
+
+
+async def main(workers=2, channels=4, users=2):
+    coordinator = Coordinator(FakeTransport(users), workers)
+    coordinator.start()
+    for channel_id in range(channels):
+        coordinator.assign(channel_id)
+    try:
+        await asyncio.sleep(5)
+        victim = coordinator.processes[0]
+        logger.info(f"Killing worker 0 (pid {victim.pid})")
+        victim.kill()
+        await asyncio.sleep(5)
+        logger.info(f"{coordinator!r}")
+    finally:
+        await coordinator.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)-15s %(levelname)s[coordinator] %(message)s')
+    asyncio.run(main(*map(int, sys.argv[1:])))
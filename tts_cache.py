@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import inspect
+import json
+import logging
+import mmap
+import os
+from collections import OrderedDict
+from functools import wraps
+from struct import Struct
+from typing import Iterable, Optional
+
+from utils import Audio, language
+
+logger = logging.getLogger(__name__)
+
+
+class TTSCache:
+    """
+    Two-tier cache of synthesized speech.
+
+    The first tier is an in-memory LRU bounded by `max_bytes` of PCM,
+    the second one is an on-disk content-addressed store, memory-mapped on load.
+    """
+    header = Struct('<HHI')  # channels, width, rate
+
+    def __init__(self, directory='tts-cache', max_bytes=64 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.in_flight = {}
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return (
+            f'memory_hits={self.memory_hits} disk_hits={self.disk_hits} misses={self.misses} '
+            f'hit_ratio={self.hit_ratio:.2f} entries={len(self.memory)} bytes={self.memory_bytes}/{self.max_bytes}'
+        )
+
+    def __repr__(self):
+        return f'<{type(self).__name__}>[{self}]'
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / total if total else 0
+
+    @staticmethod
+    def make_key(**params) -> str:
+        return hashlib.sha256(json.dumps(params, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f'{key}.pcm')
+
+    def get(self, key: str) -> Optional[Audio]:
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.memory_hits += 1
+            return self.memory[key]
+        audio = self.load(key)
+        if audio is not None:
+            self.disk_hits += 1
+            self.remember(key, audio)
+        return audio
+
+    def put(self, key: str, audio: Audio):
+        self.remember(key, audio)
+        self.store(key, audio)
+
+    def store(self, key: str, audio: Audio):
+        try:
+            self.save(key, audio)
+        except OSError as exc:
+            logger.warning(f"Can't save {key} to {self!r}: {exc}")
+
+    def remember(self, key: str, audio: Audio):
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key).data)
+        self.memory[key] = audio
+        self.memory_bytes += len(audio.data)
+        while self.memory_bytes > self.max_bytes and len(self.memory) > 1:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted.data)
+
+    def load(self, key: str) -> Optional[Audio]:
+        try:
+            with open(self.get_path(key), 'rb') as f:
+                data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except (OSError, ValueError):
+            return None
+        channels, width, rate = self.header.unpack(data[:self.header.size])
+        return Audio(channels=channels, width=width, rate=rate, data=data[self.header.size:])
+
+    def save(self, key: str, audio: Audio):
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.header.pack(audio.channels, audio.width, audio.rate))
+            f.write(audio.data)
+        # Readers (maybe in other processes) never see a partially written file
+        os.replace(tmp_path, path)
+
+    async def get_or_synthesize(self, key: str, synthesize) -> Audio:
+        """Return cached audio or await `synthesize()`, concurrent misses of the same key are coalesced"""
+        audio = self.get(key)
+        if audio is not None:
+            return audio
+        if key not in self.in_flight:
+            self.misses += 1
+            task = asyncio.ensure_future(self.synthesize(key, synthesize))
+            # Also when the task is cancelled before it starts running
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+            self.in_flight[key] = [task, 0]
+        entry = self.in_flight[key]
+        entry[1] += 1
+        try:
+            # One waiter being interrupted does not cancel synthesis for the others
+            return await asyncio.shield(entry[0])
+        except asyncio.CancelledError:
+            if entry[1] == 1:
+                # Nobody else waits: stop the request in flight
+                entry[0].cancel()
+            raise
+        finally:
+            entry[1] -= 1
+
+    async def synthesize(self, key: str, synthesize) -> Audio:
+        audio = await synthesize()
+        self.remember(key, audio)
+        # Do not make listeners wait for the disk
+        asyncio.get_running_loop().run_in_executor(None, self.store, key, audio)
+        return audio
+
+    def cached(self, provider: str, voice: str, rate: int):
+        """Decorate TTS coroutine function to look its result up in cache first"""
+        def decorator(func):
+            signature = inspect.signature(func)
+
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                # Key by argument names, so that `f('hi')` and `f(text='hi')` share the entry
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                key = self.make_key(
+                    provider=provider, voice=voice, language=language.get(), rate=rate, **bound.arguments)
+                return await self.get_or_synthesize(key, lambda: func(*args, **kwargs))
+            return wrapper
+        return decorator
+
+    async def warm_up(self, synthesize, phrases: Iterable[str]):
+        """Pre-render `phrases` with `synthesize`, which should be a cached TTS function"""
+        for phrase in phrases:
+            try:
+                await synthesize(phrase)
+            except Exception as exc:
+                logger.warning(f"Can't warm up {self!r} with '{phrase}': {exc}")
+        logger.info(f"Warmed up {self!r}")
+
+
+cache = TTSCache(
+    directory=os.getenv('TTS_CACHE_DIR', 'tts-cache'),
+    max_bytes=int(os.getenv('TTS_CACHE_BYTES', 64 << 20)),
+)
@@ -1,25 +1,30 @@
 import audioop
 import io
+from bisect import bisect_right
 
 import asyncio
-import dialogflow_v2 as dialogflow
+import multiprocessing
 import os
 import logging
 import pickle
+import re
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 from _contextvars import ContextVar
 
+import numpy as np
 import simpleaudio
 import wave
 from contextlib import contextmanager, suppress, asynccontextmanager
 from dataclasses import dataclass
 from functools import partial
+from typing import AsyncIterator, Awaitable, Iterable, List
 
 
 logger = logging.getLogger(__name__)
 contexts_var = ContextVar('contexts', default=[])
 language = ContextVar('language', default=os.getenv('DIALOGFLOW_LANGUAGE'))
-DIALOGFLOW_PROJECT = os.environ['DIALOGFLOW_PROJECT']
-DIALOGFLOW_LANGUAGE = os.environ['DIALOGFLOW_LANGUAGE']
 
 
 @dataclass
@@ -37,9 +42,12 @@ class Audio:
         return f'{type(self)}[{self}]'
 
     def __add__(self, other):
-        if other.channels != self.channels or other.width != self.width or other.rate != self.rate:
+        if not self.is_compatible(other):
             raise ValueError("Could not add incompatible Audio")
-        return self.clone(self.data + other.data)
+        return self.clone(b''.join([self.data, other.data]))
+
+    def is_compatible(self, other) -> bool:
+        return other.channels == self.channels and other.width == self.width and other.rate == self.rate
 
     def __mul__(self, factor):
         return self.clone(audioop.mul(self.data, self.width, factor))
@@ -49,7 +57,7 @@ class Audio:
 
     def clone(self, data):
         """Return clone with different data"""
-        return Audio(width=self.width, channels=self.channels, rate=self.rate, data=data)
+        return type(self)(width=self.width, channels=self.channels, rate=self.rate, data=data)
 
     def __getitem__(self, slice):
         """Slice frames"""
@@ -85,7 +93,7 @@ class Audio:
         if self.channels == 1:
             return self
         elif self.channels == 2:
-            return Audio(
+            return type(self)(
                 channels=1, width=self.width, rate=self.rate,
                 data=audioop.tomono(self.data, self.width, 0.5, 0.5)
             )
@@ -96,7 +104,7 @@ class Audio:
         if self.channels == 2:
             return self
         elif self.channels == 1:
-            return Audio(
+            return type(self)(
                 channels=2, width=self.width, rate=self.rate,
                 data=audioop.tostereo(self.data, self.width, 0.5, 0.5)
             )
@@ -104,13 +112,15 @@ class Audio:
             raise ValueError(f"Can't convert audio with channels={self.channels}")
 
     def to_rate(self, rate) -> 'Audio':
+        if rate == self.rate:
+            return self
         converted, _ = audioop.ratecv(self.data, self.width, self.channels, self.rate, rate, None)
-        return Audio(channels=self.channels, width=self.width, rate=rate, data=converted)
+        return type(self)(channels=self.channels, width=self.width, rate=rate, data=converted)
 
     @classmethod
     def load(cls, fp: str) -> 'Audio':
         with wave.open(fp, 'rb') as f:
-            return Audio(
+            return cls(
                 data=f.readframes(2 ** 32),
                 channels=f.getnchannels(),
                 width=f.getsampwidth(),
@@ -144,6 +154,222 @@ class Audio:
             play.stop()
 
 
+class NumpyAudio(Audio):
+    """
+    `Audio` doing DSP with numpy on int16 samples instead of `audioop`.
+
+    Samples are read with `np.frombuffer`, so wrapping `bytes` or a memoryview does not copy.
+    Results match `audioop` (floor rounding and saturation).
+    """
+    def __post_init__(self):
+        if self.width != 2:
+            raise ValueError(f"{type(self).__name__} supports only 16-bit audio, got width={self.width}")
+
+    @classmethod
+    def from_audio(cls, audio: Audio) -> 'NumpyAudio':
+        return cls(channels=audio.channels, width=audio.width, rate=audio.rate, data=audio.data)
+
+    @classmethod
+    def from_samples(cls, samples: np.ndarray, rate: int) -> 'NumpyAudio':
+        """Wrap (frames, channels) int16 array without copying"""
+        samples = np.ascontiguousarray(samples, dtype=np.int16)
+        return cls(channels=samples.shape[1], width=2, rate=rate, data=memoryview(samples).cast('B'))
+
+    @property
+    def samples(self) -> np.ndarray:
+        """Read-only (frames, channels) int16 array sharing memory with `data`"""
+        return np.frombuffer(self.data, dtype=np.int16).reshape(-1, self.channels)
+
+    def __mul__(self, factor):
+        return self.from_samples(saturate(self.samples.astype(np.float64) * factor), self.rate)
+
+    def combine(self, other):
+        # `other` may be a plain `Audio`, which has no `samples`
+        if len(other.data) != len(self.data):
+            raise ValueError(f"Can't combine audio of {len(self.data)} and {len(other.data)} bytes")
+        other_samples = np.frombuffer(other.data, dtype=np.int16).reshape(-1, self.channels)
+        return self.from_samples(saturate(self.samples.astype(np.int32) + other_samples), self.rate)
+
+    @property
+    def rms(self) -> float:
+        samples = self.samples.ravel().astype(np.float64)
+        return int(np.sqrt(np.dot(samples, samples) / max(len(samples), 1)))
+
+    def to_mono(self):
+        if self.channels == 1:
+            return self
+        elif self.channels == 2:
+            return self.from_samples(downmix(self.samples), self.rate)
+        else:
+            raise ValueError(f"Can't convert audio with channels={self.channels}")
+
+    def to_stereo(self):
+        if self.channels == 2:
+            return self
+        elif self.channels == 1:
+            return self.from_samples(saturate(np.repeat(self.samples * 0.5, 2, axis=1)), self.rate)
+        else:
+            raise ValueError(f"Can't convert audio with channels={self.channels}")
+
+    def silence(self, frames: int) -> 'NumpyAudio':
+        return self.from_samples(np.zeros((frames, self.channels), dtype=np.int16), self.rate)
+
+
+def saturate(samples: np.ndarray) -> np.ndarray:
+    """Round down and clip to int16 the same way `audioop` does"""
+    if samples.dtype.kind == 'f':
+        samples = np.floor(samples)
+    return np.clip(samples, -2 ** 15, 2 ** 15 - 1).astype(np.int16)
+
+
+def downmix(samples: np.ndarray) -> np.ndarray:
+    """(..., frames, 2) -> (..., frames, 1) with the same factors as `Audio.to_mono`"""
+    return saturate(samples[..., 0] * 0.5 + samples[..., 1] * 0.5)[..., np.newaxis]
+
+
+def batch_rms(audios: List[Audio]) -> np.ndarray:
+    """RMS of many 16-bit packets (e.g. one per user in a tick) in a single pass"""
+    sizes = np.array([len(audio.data) // 2 for audio in audios], dtype=np.int64)
+    if len(audios) and sizes.min() == sizes.max():
+        samples = np.stack([np.frombuffer(audio.data, dtype=np.int16) for audio in audios]).astype(np.float64)
+        sums = np.einsum('ij,ij->i', samples, samples)
+    else:
+        sums = np.array([np.dot(samples, samples) for samples in (
+            np.frombuffer(audio.data, dtype=np.int16).astype(np.float64) for audio in audios
+        )])
+    return np.floor(np.sqrt(sums / np.maximum(sizes, 1)))
+
+
+class AudioBuffer:
+    """
+    Growable audio buffer with amortized O(1) append and in-place consumption from the front.
+
+    Slices are returned as `Audio` over a read-only memoryview, so they are not copied.
+    Bytes under an exported view are never overwritten: when the buffer runs out of space
+    the live frames are moved into a new bytearray and old views keep referencing the old one.
+    """
+    def __init__(self, channels: int, width: int, rate: int, capacity: int = 0):
+        self.channels = channels
+        self.width = width
+        self.rate = rate
+        self.buffer = bytearray(capacity * self.framewidth)
+        self.start = 0
+        self.end = 0
+        self.exported = False
+
+    @classmethod
+    def like(cls, audio: Audio, capacity: int = 0) -> 'AudioBuffer':
+        return cls(channels=audio.channels, width=audio.width, rate=audio.rate, capacity=capacity)
+
+    def __str__(self):
+        return f'{self.audio} capacity={len(self.buffer) // self.framewidth}'
+
+    def __repr__(self):
+        return f'{type(self)}[{self}]'
+
+    def __len__(self) -> int:
+        """Buffer length in frames"""
+        return (self.end - self.start) // self.framewidth
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    def __iadd__(self, audio: Audio) -> 'AudioBuffer':
+        self.append(audio)
+        return self
+
+    def __getitem__(self, slice) -> Audio:
+        """Slice frames without copying"""
+        return self.audio[slice]
+
+    @property
+    def framewidth(self) -> int:
+        return self.channels * self.width
+
+    @property
+    def duration(self) -> float:
+        """Duration in seconds"""
+        return len(self) / self.rate
+
+    @property
+    def audio(self) -> Audio:
+        """Read-only view of the buffered frames"""
+        self.exported = True
+        data = memoryview(self.buffer).toreadonly()[self.start:self.end]
+        return Audio(channels=self.channels, width=self.width, rate=self.rate, data=data)
+
+    def append(self, audio: Audio):
+        if not self.is_compatible(audio):
+            raise ValueError("Could not append incompatible Audio")
+        size = len(audio.data)
+        self.reserve(size)
+        self.buffer[self.end:self.end + size] = audio.data
+        self.end += size
+
+    def reserve(self, size: int):
+        """Make room for `size` more bytes at the end"""
+        if self.end + size <= len(self.buffer):
+            return
+        live = self.end - self.start
+        # Leave at least as much free space as was copied, so moving is amortized O(1) per appended byte
+        buffer = bytearray(2 * (live + size))
+        buffer[:live] = self.buffer[self.start:self.end]
+        self.buffer = buffer
+        self.start = 0
+        self.end = live
+        self.exported = False
+
+    def consume(self, frames: int):
+        """Drop `frames` from the front"""
+        self.start = min(self.start + frames * self.framewidth, self.end)
+        if self.start == self.end:
+            self.clear()
+
+    def pop(self, frames: int) -> Audio:
+        """Return first `frames` and drop them from the front"""
+        head = self[:frames]
+        self.consume(frames)
+        return head
+
+    def clear(self):
+        if self.exported:
+            # Do not overwrite frames someone still looks at
+            self.buffer = bytearray(len(self.buffer))
+            self.exported = False
+        self.start = self.end = 0
+
+    def is_compatible(self, audio: Audio) -> bool:
+        return audio.channels == self.channels and audio.width == self.width and audio.rate == self.rate
+
+
+class Resampler:
+    """
+    Streaming channels/rate converter.
+
+    Unlike `Audio.to_rate` it carries `ratecv` filter state from one packet to the next,
+    so a stream converted packet by packet has no seams on packet boundaries.
+    Use one instance per stream.
+    """
+    def __init__(self, channels: int, rate: int):
+        self.channels = channels
+        self.rate = rate
+        self.state = None
+
+    def __repr__(self):
+        return f'{type(self).__name__}<channels={self.channels} rate={self.rate}Hz>'
+
+    def __call__(self, audio: Audio) -> Audio:
+        # Downmix first to resample as few samples as possible
+        audio = audio.to_mono() if self.channels == 1 else audio.to_stereo()
+        if audio.rate == self.rate:
+            return audio
+        data, self.state = audioop.ratecv(audio.data, audio.width, audio.channels, audio.rate, self.rate, self.state)
+        return type(audio)(channels=self.channels, width=audio.width, rate=self.rate, data=data)
+
+    def reset(self):
+        self.state = None
+
+
 class Registry:
     def __init__(self):
         self.skills = {}
@@ -204,6 +430,8 @@ class BackgroundTask:
         self.task = asyncio.create_task(coro)
 
     async def stop(self):
+        if self.task is None:
+            return
         self.task.cancel()
         with suppress(asyncio.CancelledError):
             await self.task
@@ -224,14 +452,312 @@ async def sync_to_async(func, *args, **kwargs):
     return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
 
 
-class EmptyUtterance(Exception):
-    pass
+class InferencePool:
+    """
+    Dedicated bounded executor for blocking native inference (Porcupine, webrtcvad).
+
+    `run` has `sync_to_async` semantics, but uses its own threads or processes instead of
+    the loop's default executor, and at most `max_pending` calls are in flight:
+    the rest wait for a free slot instead of piling up (backpressure).
+    In 'process' mode `func` and its arguments must be picklable.
+    """
+    def __init__(self, mode='thread', workers=1, max_pending=16, initializer=None, initargs=()):
+        if mode == 'thread':
+            self.executor = ThreadPoolExecutor(
+                workers, thread_name_prefix='inference', initializer=initializer, initargs=initargs)
+        elif mode == 'process':
+            self.executor = ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('spawn'), initializer=initializer, initargs=initargs)
+        else:
+            raise ValueError(f"Unknown inference pool mode: {mode}")
+        self.mode = mode
+        self.slots = asyncio.Semaphore(max_pending)
+        self.pending = 0
+        # Submitted and not done yet, cancelled on shutdown
+        self.futures = set()
+
+    def __repr__(self):
+        return f'<{type(self).__name__}>[mode={self.mode} pending={self.pending}]'
+
+    async def run(self, func, *args, **kwargs):
+        async with self.slots:
+            self.pending += 1
+            try:
+                return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+            finally:
+                self.pending -= 1
+
+    def call(self, func, *args, **kwargs):
+        """Run `func` in the pool and block until it is done"""
+        return self.submit(func, *args, **kwargs).result()
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        future = self.executor.submit(func, *args, **kwargs)
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+        return future
+
+    def shutdown(self):
+        # Executor.shutdown(cancel_futures=True) is Python 3.9+: calls not started yet are cancelled here
+        for future in list(self.futures):
+            future.cancel()
+        self.executor.shutdown(wait=False)
+
+
+class FrameBus:
+    """
+    Broadcast of frames to any number of subscribers without copying them.
+
+    Published frames are kept in a ring of `capacity` slots, every `Subscription` has its own cursor into it.
+    A subscriber lagging behind more than its `max_lag` frames loses frames by its policy: 'drop-oldest' skips
+    the oldest ones, 'drop-newest' rejects new ones until it catches up. Either way a slow consumer
+    neither blocks the publisher nor the other subscribers.
+    """
+    policies = ('drop-oldest', 'drop-newest')
+
+    def __init__(self, capacity: int):
+        self.slots = [None] * capacity
+        self.seq = 0
+        self.subscriptions = set()
+        self.ready = asyncio.Event()
+
+    def __repr__(self):
+        return f'<{type(self).__name__}>[seq={self.seq} {list(self.subscriptions)}]'
+
+    def publish(self, frame):
+        self.slots[self.seq % len(self.slots)] = frame
+        self.seq += 1
+        for subscription in self.subscriptions:
+            if subscription.held is not None:
+                subscription.hold(frame)
+        self.ready.set()
+
+    def subscribe(self, max_lag: int = None, name='', policy='drop-oldest') -> 'Subscription':
+        """Subscribe to frames published from now on, use as a context manager to unsubscribe"""
+        if policy not in self.policies:
+            raise ValueError(f"Unknown drop policy: {policy}")
+        subscription = Subscription(self, min(max_lag or len(self.slots), len(self.slots)), name, policy)
+        self.subscriptions.add(subscription)
+        return subscription
+
+
+class Subscription:
+    def __init__(self, bus: FrameBus, max_lag: int, name: str, policy: str):
+        self.bus = bus
+        self.max_lag = max_lag
+        self.name = name
+        self.policy = policy
+        self.cursor = bus.seq
+        # Frames kept by 'drop-newest' may be overwritten in the ring meanwhile, so it holds references to them
+        self.held = deque() if policy == 'drop-newest' else None
+        self.peak_lag = 0
+        self.dropped = 0
+
+    def __repr__(self):
+        return (
+            f'<{type(self).__name__}>[{self.name} lag={self.lag} peak_lag={self.peak_lag} dropped={self.dropped} '
+            f'{self.policy}]'
+        )
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc_info):
+        self.close()
 
-def extract_intent(session_id, text, project_id=DIALOGFLOW_PROJECT, language_code=DIALOGFLOW_LANGUAGE):
-    session_client = dialogflow.SessionsClient()
-    session = session_client.session_path(project_id, session_id)
-    text_input = dialogflow.types.TextInput(text=text, language_code=language_code)
-    query_input = dialogflow.types.QueryInput(text=text_input)
-    response = session_client.detect_intent(session=session, query_input=query_input)
-    return response
+    @property
+    def lag(self) -> int:
+        if self.held is not None:
+            return len(self.held)
+        return self.bus.seq - self.cursor
+
+    def close(self):
+        self.bus.subscriptions.discard(self)
+
+    def flush(self):
+        """Skip all frames published so far"""
+        self.cursor = self.bus.seq
+        if self.held is not None:
+            self.held.clear()
+
+    def hold(self, frame):
+        if len(self.held) >= self.max_lag:
+            self.dropped += 1
+            return
+        self.held.append(frame)
+
+    def get_nowait(self):
+        lag = self.lag
+        if not lag:
+            raise asyncio.QueueEmpty()
+        self.peak_lag = max(self.peak_lag, lag)
+        if self.held is not None:
+            return self.held.popleft()
+        if lag > self.max_lag:
+            self.dropped += lag - self.max_lag
+            self.cursor = self.bus.seq - self.max_lag
+        frame = self.bus.slots[self.cursor % len(self.bus.slots)]
+        self.cursor += 1
+        return frame
+
+    async def get(self):
+        while not self.lag:
+            self.bus.ready.clear()
+            await self.bus.ready.wait()
+        return self.get_nowait()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+
+async def iterate_queue(queue: asyncio.Queue):
+    """Yield items from `queue` until None"""
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        yield item
+
+
+async def ordered_concurrently(coros: Iterable[Awaitable], limit: int) -> AsyncIterator:
+    """Run at most `limit` of `coros` at once and yield their results in order"""
+    tasks = deque()
+    try:
+        for coro in coros:
+            tasks.append(asyncio.ensure_future(coro))
+            if len(tasks) >= limit:
+                yield await tasks.popleft()
+        while tasks:
+            yield await tasks.popleft()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class LatencyTracker:
+    """Rolling window of successful request latencies"""
+    def __init__(self, name: str, window=100, default=1.0):
+        self.name = name
+        self.default = default
+        self.latencies = deque(maxlen=window)
+
+    def __repr__(self):
+        return f'<{type(self).__name__}>[{self.name} p50={self.percentile(0.5):.3f}s p95={self.percentile(0.95):.3f}s]'
+
+    def percentile(self, q: float) -> float:
+        if not self.latencies:
+            return self.default
+        latencies = sorted(self.latencies)
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+
+    async def measure(self, coro):
+        """Await `coro` and record its latency unless it fails or gets cancelled"""
+        start = time.perf_counter()
+        result = await coro
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+
+async def hedge(primary, secondary, delay: float, is_good=bool):
+    """
+    Hedged request: await `primary()`, also start `secondary()` after `delay` seconds
+    or as soon as primary fails. Return the first good result and cancel the other request.
+    If neither is good, a bad result or `EmptyUtterance` is preferred to other errors.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + delay
+    pending = {asyncio.ensure_future(primary())}
+    secondary_started = False
+    finished = []
+    try:
+        while pending or not secondary_started:
+            if not secondary_started and (not pending or loop.time() >= deadline):
+                pending.add(asyncio.ensure_future(secondary()))
+                secondary_started = True
+            timeout = None if secondary_started else deadline - loop.time()
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.exception() and is_good(task.result()):
+                    return task.result()
+                finished.append(task)
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    # Neither was good: if one of them heard nothing, so be it, even if the other one failed
+    for task in finished:
+        if not task.exception() or isinstance(task.exception(), EmptyUtterance):
+            return task.result()
+    return finished[-1].result()
+
+
+class Histogram:
+    """Counts of values by bucket, `bounds` are upper bounds in seconds"""
+    def __init__(self, bounds=(0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5)):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+
+    def __str__(self):
+        buckets = [f'<{bound * 1000:g}ms:{count}' for bound, count in zip(self.bounds, self.counts)]
+        buckets.append(f'>={self.bounds[-1] * 1000:g}ms:{self.counts[-1]}')
+        return ' '.join(buckets)
+
+    def __len__(self):
+        return sum(self.counts)
+
+    def add(self, value: float):
+        self.counts[bisect_right(self.bounds, value)] += 1
+
+
+class TokenBucket:
+    """Allow `burst` events at once and `rate` events per second on average"""
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def __repr__(self):
+        return f'<{type(self).__name__}>[{self.tokens:.1f}/{self.burst} +{self.rate}/s]'
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+SENTENCE_END = re.compile(r'(?<=[.!?…;])\s+')
+
+
+def split_sentences(text: str, max_length=200) -> List[str]:
+    """Split text to sentences, also splitting sentences longer than `max_length` by words"""
+    parts = []
+    for sentence in SENTENCE_END.split(text.strip()):
+        part = ''
+        for word in sentence.split():
+            if part and len(part) + len(word) >= max_length:
+                parts.append(part)
+                part = ''
+            part = f'{part} {word}' if part else word
+        if part:
+            parts.append(part)
+    return parts
+
+
+@dataclass
+class Transcript:
+    """Streaming speech recognition result"""
+    text: str
+    is_final: bool
+
+
+class EmptyUtterance(Exception):
+    pass
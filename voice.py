@@ -1,43 +1,155 @@
 import asyncio
 import logging
+import os
 import time
-from typing import List
-from struct import Struct
+from typing import List, Optional, Union
 from contextlib import suppress, asynccontextmanager
 
 from discord import VoiceClient, SpeakingState
 from discord.reader import AudioSink, AudioReader
 from discord.opus import Decoder, Encoder
-from webrtcvad import Vad
-from pvporcupine import create
 
 import google_cloud
-import google_cloud as yandex  # FIXME: Get yandex API key
-from utils import set_contexts, BackgroundTask, background_task, registry, language, Audio, EmptyUtterance
-from google_cloud import detect_intent
+if os.getenv('YANDEX_API_KEY'):
+    import yandex_cloud as yandex
+else:
+    import google_cloud as yandex  # FIXME: Get yandex API key
+from utils import (
+    set_contexts, BackgroundTask, background_task, registry, language, Audio, AudioBuffer, Resampler, EmptyUtterance,
+    iterate_queue, LatencyTracker, hedge, FrameBus, Histogram,
+)
+from intents import detect_intent
+from prompts import Prompt, prompts
+from wakeword import WakeWordScheduler
 
 
 logger = logging.getLogger(__name__)
+# Porcupine, webrtcvad and STT all consume 16 kHz mono
+VOICE_RATE = 16000
+# Recognize speech while the user is still talking
+STREAMING_STT = os.getenv('STREAMING_STT') == '1'
+# Hedged STT: 'off', 'adaptive' (start secondary provider after primary's p95 latency) or delay in seconds
+STT_HEDGE = os.getenv('STT_HEDGE', 'adaptive')
+# Packets (20ms each) kept per user and what a listener lagging behind more than that loses
+INPUT_QUEUE_PACKETS = int(os.getenv('INPUT_QUEUE_PACKETS', 250))
+INPUT_QUEUE_POLICY = os.getenv('INPUT_QUEUE_POLICY', 'drop-oldest')
+# Trailing silence (seconds) ending an utterance at first, then it is adapted to pauses of the user
+ENDPOINT_SILENCE = float(os.getenv('ENDPOINT_SILENCE', 0.5))
+ENDPOINT_ADAPTATION = float(os.getenv('ENDPOINT_ADAPTATION', 0.3))
+MAX_UTTERANCE = float(os.getenv('MAX_UTTERANCE', 15))
+# Seconds without packets after which an idle user's sink is closed (created again on next packet)
+SINK_IDLE_TIMEOUT = float(os.getenv('SINK_IDLE_TIMEOUT', 300))
+# Phrases synthesized in advance to be played without TTS round trip
+WARMUP_PHRASES = os.getenv('TTS_WARMUP_PHRASES', '|'.join([
+    "Ну что же ты молчишь?",
+    "В следующий раз я тоже тебе не отвечу!",
+    "такого я не умею",
+])).split('|')
+
+
+class Endpointer:
+    """
+    Decides when an utterance ends from per-frame speech decisions, in frame time.
+
+    Speech starts after `onset` seconds of speech frames and ends after `threshold` seconds of silence.
+    A single speech frame within the silence (a click, a breath) does not restart the speech.
+    After every turn `threshold` moves towards the longest pause the user made mid-utterance,
+    so it is kept short for users who speak in one go and longer for those who pause.
+    """
+    def __init__(self, silence=0.5, min_silence=0.25, max_silence=1.2, max_utterance=15.0, onset=0.2,
+                 adaptation=0.3, resume=2):
+        self.threshold = silence
+        self.min_silence = min_silence
+        self.max_silence = max_silence
+        self.max_utterance = max_utterance
+        self.onset = onset
+        self.adaptation = adaptation
+        self.resume = resume
+        self.start(0)
+
+    def __repr__(self):
+        return (
+            f'<{type(self).__name__}>[threshold={self.threshold:.2f}s elapsed={self.elapsed:.2f}s '
+            f'speech={self.speech:.2f}s pauses={len(self.pauses)}]'
+        )
+
+    def start(self, timeout: float):
+        self.timeout = timeout
+        self.elapsed = 0
+        self.speech = 0
+        self.silence = 0
+        self.run = 0
+        self.pauses = []
+
+    @property
+    def started(self) -> bool:
+        return self.speech >= self.onset
+
+    def time_left(self) -> float:
+        """Seconds until the utterance ends if only silence follows"""
+        if self.started:
+            left = self.threshold - self.silence
+        else:
+            left = self.timeout - self.elapsed
+        return max(min(left, self.max_utterance - self.elapsed), 0)
+
+    def update(self, is_speech: bool, duration: float) -> Optional[str]:
+        """Account a frame, return why the utterance is over or None"""
+        self.elapsed += duration
+        if is_speech:
+            self.run += 1
+            if not self.started or self.run >= self.resume:
+                if self.started and self.silence:
+                    self.pauses.append(self.silence)
+                self.speech += duration
+                self.silence = 0
+        else:
+            self.run = 0
+            self.silence += duration
+        if self.elapsed >= self.max_utterance:
+            return 'max-utterance' if self.started else 'no-speech'
+        if self.started and self.silence >= self.threshold:
+            return 'silence'
+        if not self.started and self.elapsed >= self.timeout:
+            return 'no-speech'
+
+    def finish(self):
+        """Adapt the threshold to pauses of the turn"""
+        if not self.started:
+            return
+        target = max(self.pauses) * 1.3 if self.pauses else self.min_silence
+        target = min(max(target, self.min_silence), self.max_silence)
+        self.threshold += self.adaptation * (target - self.threshold)
 
 
 class UserSink:
     def __init__(self, parent, keywords, user):
         self.parent = parent
         self.user = user
-        self.pcp = create(keywords=keywords, sensitivities=[0.5] * len(keywords))
-        self.unpacker = Struct(f'{self.pcp.frame_length}h')
-        self.input_queue = asyncio.Queue()
+        self.key = user.id
+        self.wakeword = parent.wakeword
+        self.gate_processed = 0
+        self.gate_gated = 0
+        self.resampler = Resampler(channels=1, rate=VOICE_RATE)
+        # 16 kHz mono frames of the user, shared by all consumers
+        self.frames = FrameBus(INPUT_QUEUE_PACKETS)
+        self.endpointer = Endpointer(
+            silence=ENDPOINT_SILENCE, max_utterance=MAX_UTTERANCE, adaptation=ENDPOINT_ADAPTATION)
+        self.busy = False
+        self.last_active = time.monotonic()
 
         self.what = parent.what
         self.that = parent.that
         self.ticktock = parent.ticktock
+        self.what_prompt = parent.what_prompt
+        self.that_prompt = parent.that_prompt
+        self.ticktock_prompt = parent.ticktock_prompt
         self.keywords = parent.keywords
         self.play = parent.play
         self.play_loop = parent.play_loop
         self.play_stream = parent.play_stream
         self.play_interruptible = parent.play_interruptible
         self.speak = parent.speak
-        self.vad = Vad(3)
         self.listen_task = BackgroundTask()
         self.listen_task.start(self.listen_loop())
         logger.info(f"Started {self!r}")
@@ -46,15 +158,13 @@ class UserSink:
         return f'{type(self).__name__}<{self.user}>'
 
     def detect_wuw(self, sound: Audio):
-        result = self.pcp.process(self.unpacker.unpack(sound.data))
-        if result >= 0:
-            return self.keywords[result]
+        return self.wakeword.detect(self, sound)
 
     async def process_wakeup(self):
         try:
-            utterance: Audio = await self.listen_audio()
+            text = await self.recognize()
             with set_contexts():
-                await self.process_utterance(utterance)
+                await self.process_text(text)
         except EmptyUtterance:
             await self.speak("В следующий раз я тоже тебе не отвечу!")
         except Interrupted:
@@ -62,67 +172,111 @@ class UserSink:
 
     async def wait_for_wuw(self) -> str:
         """Listen for wake up word and return it"""
-        sound = Audio(rate=self.pcp.sample_rate, channels=1, width=2)
-        while True:
-            sound += (await self.listen()).to_mono().to_rate(self.pcp.sample_rate)
-            while len(sound) >= self.pcp.frame_length:
-                to_process = sound[:self.pcp.frame_length]
-                sound = sound[self.pcp.frame_length:]
-                keyword = self.detect_wuw(to_process)
-                if keyword:
-                    logger.info(f'Detected keyword "{keyword}"')
-                    return keyword
+        keyword = await self.wakeword.wait(self)
+        logger.info(f'Detected keyword "{keyword}"')
+        return keyword
 
     async def listen_loop(self):
         while True:
             try:
                 await self.wait_for_wuw()
-                async with self.parent.attention:
-                    await self.process_wakeup()
+                self.busy = True
+                try:
+                    async with self.parent.attention:
+                        await self.process_wakeup()
+                finally:
+                    self.busy = False
             except Exception as exc:
                 logger.exception(f"Unexpected exception in {self!r}.listen_loop: {exc}")
 
-    async def listen_audio(self, timeout=2.3) -> Audio:
+    async def listen_audio(self, timeout=2.3, chunks: asyncio.Queue = None) -> Audio:
+        """
+        Listen utterance, also putting packets since speech onset and then None to `chunks` if set.
+
+        Raise `EmptyUtterance` if speech does not start in `timeout` seconds.
+        """
         logger.info(f"{self!r} start listening utterance with timeout {timeout}")
-        async with background_task(self.play_loop(self.ticktock)):
-            sound = Audio(channels=Decoder.CHANNELS, width=2, rate=Decoder.SAMPLING_RATE)
-            speech_count = 0
-            speech_threshold = 10
-            self.input_queue = asyncio.Queue()
-            while True:
-                try:
-                    actual_timeout = 0.4 if speech_count >= speech_threshold else timeout
-                    packet = await asyncio.wait_for(self.listen(), timeout=actual_timeout)
+        async with background_task(self.play_loop(self.ticktock_prompt)):
+            sound = AudioBuffer(channels=1, width=2, rate=VOICE_RATE)
+            endpointer = self.endpointer
+            endpointer.start(timeout)
+            with self.frames.subscribe(name='listen', policy=INPUT_QUEUE_POLICY) as frames:
+                reason = None
+                while reason is None:
+                    time_left = endpointer.time_left()
+                    try:
+                        packet = await asyncio.wait_for(frames.get(), timeout=time_left)
+                    except asyncio.TimeoutError:
+                        # No packets at all while the user does not transmit
+                        reason = endpointer.update(False, time_left)
+                        continue
                     sound += packet
-                    is_speech = self.vad.is_speech(packet.to_mono().to_rate(16000).data, 16000)
+                    is_speech = packet.rms > 50 and await self.wakeword.is_speech(self, packet)
                     logger.debug(f"{self!r} speech packet: is_speech={is_speech} rms={packet.rms}")
-                    if is_speech and packet.rms > 50:
-                        speech_count += 1
-                except asyncio.TimeoutError:
-                    logger.info(f"{self!r} stop listening utterance")
-                    if len(sound) == 0:
-                        raise EmptyUtterance()
-                    logger.info(f"{self!r} listened speech: {sound.duration}s", extra=dict(speech=sound))
-                    return sound
-
-    async def listen(self) -> Audio:
-        return await self.input_queue.get()
+                    reason = endpointer.update(is_speech, packet.duration)
+                    if chunks is not None and endpointer.speech:
+                        chunks.put_nowait(packet)
+            endpointer.finish()
+            logger.info(f"{self!r} stop listening utterance: {reason}, {endpointer!r} {frames!r}")
+            if chunks is not None:
+                chunks.put_nowait(None)
+            if reason == 'no-speech':
+                raise EmptyUtterance()
+            logger.info(f"{self!r} listened speech: {sound.duration}s", extra=dict(speech=sound.audio))
+            return sound.audio
 
     async def feed(self, audio: Audio):
-        self.input_queue.put_nowait(audio)
-        logger.debug(f'feed: {self!r}. qsize={self.input_queue.qsize()}')
+        """Feed 16 kHz mono audio produced by `self.resampler`"""
+        self.last_active = time.monotonic()
+        # Wake word detection only queues the frame for its next batch
+        self.wakeword.feed(self, audio)
+        self.frames.publish(audio)
+
+    async def recognize(self, timeout=2.3) -> str:
+        """Listen utterance and return its text"""
+        if STREAMING_STT:
+            text = await self.listen_streaming(timeout)
+        else:
+            text = await speech_to_text(await self.listen_audio(timeout=timeout))
+        if not text:
+            raise EmptyUtterance()
+        return text
+
+    async def listen_streaming(self, timeout=2.3) -> str:
+        """Listen utterance feeding it to streaming STT, return final transcript as soon as speech is over"""
+        chunks = asyncio.Queue()
+        recognition = asyncio.create_task(self.collect_transcript(iterate_queue(chunks)))
+        try:
+            await self.listen_audio(timeout=timeout, chunks=chunks)
+        except BaseException:
+            recognition.cancel()
+            with suppress(asyncio.CancelledError):
+                await recognition
+            raise
+        return await recognition
+
+    async def collect_transcript(self, chunks) -> str:
+        finals = []
+        async for transcript in streaming_speech_to_text(chunks):
+            if transcript.is_final:
+                finals.append(transcript.text)
+            else:
+                logger.debug(f"{self!r} interim transcript: {transcript.text}")
+        return ' '.join(finals).strip()
 
     async def process_utterance(self, utterance: Audio):
         text = await speech_to_text(utterance)
         if not text:
             raise EmptyUtterance()
+        await self.process_text(text)
+
+    async def process_text(self, text: str):
         intent = await detect_intent(self.user, text)
         query = intent.parameters.get('query', text)
         if intent.text:
             await self.speak(intent.text)
             if not intent.all_required_params_present:
-                user_answer: Audio = await self.listen_audio()
-                await self.process_utterance(user_answer)
+                await self.process_text(await self.recognize())
         if intent.action == 'format':
             answer = intent.text.format(query=query)
             await self.speak(answer)
@@ -140,11 +294,7 @@ class UserSink:
     async def listen_text(self, timeout=4, tries=1):
         while True:
             try:
-                speech = await self.listen_audio(timeout=timeout)
-                text = await speech_to_text(speech)
-                if not text:
-                    raise EmptyUtterance()
-                return text
+                return await self.recognize(timeout=timeout)
             except EmptyUtterance:
                 tries -= 1
                 if tries:
@@ -163,11 +313,12 @@ class UserSink:
         while tries >= 0:
             tries -= 1
             try:
-                speech = await self.listen_audio(timeout=timeout)
+                # Transcribe first, so that short answers skip Dialogflow
+                text = await self.recognize(timeout=timeout)
             except EmptyUtterance:
                 await self.speak("Ну что же ты молчишь?")
             else:
-                intent = await detect_intent(self.user, speech=speech)
+                intent = await detect_intent(self.user, text)
                 if intent.action == 'repeat':
                     await self.play(request)
                     tries += 1
@@ -184,7 +335,12 @@ class UserSink:
             return intent.action == 'yes'
 
     async def close(self):
-        self.pcp.delete()
+        await self.listen_task.stop()
+        await self.wakeword.forget(self)
+        logger.info(
+            f"Closed {self!r}: wake word packets processed={self.gate_processed} gated={self.gate_gated}, "
+            f"{self.frames!r}"
+        )
 
     async def on_welcome(self):
         logger.info(f"Welcome {self.user}")
@@ -193,14 +349,128 @@ class UserSink:
             await self.speak(intent.text)
 
 
+class PlaybackClock:
+    """
+    One timeline of 20ms frame slots for everything a channel plays.
+
+    Streams wait for `tick` before sending every frame. A frame late for its slot is sent at once to catch up.
+    When the slot is more than `max_lag` behind, the reason decides: if the stream was waiting for its producer
+    (an underrun, see `produce`) the timeline restarts from now, otherwise the loop stalled and the frame is dropped.
+    """
+    def __init__(self, interval: float, max_lag=0.1):
+        self.interval = interval
+        self.max_lag = max_lag
+        self.next = time.perf_counter()
+        self.waited = 0
+        self.sent = 0
+        self.dropped = 0
+        self.jitter = Histogram()
+        self.underruns = Histogram()
+
+    def __repr__(self):
+        return (
+            f'<{type(self).__name__}>[sent={self.sent} dropped={self.dropped} '
+            f'jitter=({self.jitter}) underruns=({self.underruns})]'
+        )
+
+    def reset(self):
+        """Start the timeline from now, when a channel starts speaking"""
+        self.next = time.perf_counter()
+        self.waited = 0
+
+    async def produce(self, stream):
+        """Iterate `stream` counting the time spent waiting for its items, so that `tick` can tell underruns"""
+        stream = stream.__aiter__()
+        while True:
+            started = time.perf_counter()
+            try:
+                item = await stream.__anext__()
+            except StopAsyncIteration:
+                return
+            self.waited += time.perf_counter() - started
+            yield item
+
+    async def tick(self) -> bool:
+        """Wait for the next slot, return False if the frame should be dropped"""
+        now = time.perf_counter()
+        waited, self.waited = self.waited, 0
+        if now - self.next > self.max_lag:
+            if waited > self.max_lag:
+                self.underruns.add(now - self.next)
+                self.next = now
+            else:
+                self.next += self.interval
+                self.dropped += 1
+                return False
+        slot = self.next
+        self.next += self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        sent = time.perf_counter()
+        self.jitter.add(max(sent - slot, 0))
+        self.sent += 1
+        return True
+
+
+class BargeInDetector:
+    """
+    Interrupts playbacks of a channel when any user, including one who joined mid-playback, says a keyword.
+
+    Subscribes to keyword detections of `WakeWordScheduler` once, so users' `listen_loop`s
+    and interruptions are served by the same detections, and nobody's wake word state is reset.
+    """
+    def __init__(self, wakeword: WakeWordScheduler):
+        self.wakeword = wakeword
+        self.playbacks = set()
+        self.interrupts = 0
+        self.reaction = Histogram()
+        wakeword.subscribe(self.on_keyword)
+
+    def __repr__(self):
+        return f'<{type(self).__name__}>[playing={len(self.playbacks)} interrupts={self.interrupts} reaction=({self.reaction})]'
+
+    def on_keyword(self, sink, keyword: str, started: float):
+        for interrupt in self.playbacks:
+            if not interrupt.done():
+                interrupt.set_result((sink, started))
+
+    async def run(self, coro):
+        """Await `coro`, cancel it and raise `Interrupted` if a keyword is detected meanwhile"""
+        interrupt = asyncio.get_running_loop().create_future()
+        playback = asyncio.ensure_future(coro)
+        self.playbacks.add(interrupt)
+        try:
+            with self.wakeword.watch():
+                await asyncio.wait([playback, interrupt], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.playbacks.discard(interrupt)
+            interrupt.cancel()
+            if not playback.done():
+                playback.cancel()
+                with suppress(asyncio.CancelledError):
+                    await playback
+        if interrupt.cancelled():
+            return playback.result()
+        sink, started = interrupt.result()
+        self.interrupts += 1
+        self.reaction.add(time.monotonic() - started)
+        logger.debug(f"Interrupted by {sink!r}")
+        raise Interrupted
+
+
 class DemultiplexerSink(AudioSink):
     """
     https://ru.wikipedia.org/wiki/%D0%94%D0%B5%D0%BC%D1%83%D0%BB%D1%8C%D1%82%D0%B8%D0%BF%D0%BB%D0%B5%D0%BA%D1%81%D0%BE%D1%80
 
     """
-    def __init__(self, voice_client: VoiceClient, keywords: List[str]):
+    def __init__(self, voice_client: VoiceClient, keywords: List[str], reader_factory=AudioReader):
         self.client = voice_client
         self.keywords = keywords
+        self.wakeword = WakeWordScheduler(
+            keywords,
+            mode=os.getenv('INFERENCE_MODE', 'thread'),
+            shards=int(os.getenv('INFERENCE_WORKERS', 1)),
+        )
         self.users = {}
         self.deleted = False
         self.is_speaking = False
@@ -208,22 +478,32 @@ class DemultiplexerSink(AudioSink):
         self.that = Audio.load('that2.wav')
         self.hello = Audio.load('hello.wav')
         self.ticktock = Audio.load('ticktock.wav')
+        # Encoded once per process and sent as is, skills keep getting the `Audio` above
+        self.what_prompt = prompts.load('what2.wav')
+        self.that_prompt = prompts.load('that2.wav')
+        self.hello_prompt = prompts.load('hello.wav')
+        self.ticktock_prompt = prompts.load('ticktock.wav')
         self.wakeups = asyncio.Queue()
-        self.reader = AudioReader(self, voice_client)
+        self.reader = reader_factory(self, voice_client)
         self.demux_task = BackgroundTask()
+        self.reap_task = BackgroundTask()
         self.attention = asyncio.Lock()
         self.speak_lock = asyncio.Lock()
+        self.clock = PlaybackClock(Encoder.FRAME_LENGTH / 1000)
+        self.barge_in = BargeInDetector(self.wakeword)
 
     def __str__(self):
-        return f'channel={self.client.channel}'
+        return f'channel={self.client.channel} users={len(self.users)}'
 
     def __repr__(self):
         return f'<{type(self).__name__}>[{self}]'
 
     async def start(self):
         self.demux_task.start(self.demux_loop())
+        self.reap_task.start(self.reap_loop())
+        self.wakeword.start()
         logger.info(f"Started {self!r}")
-        await self.play(self.hello)
+        await self.play(self.hello_prompt)
 
     async def cleanup(self):
         # TODO: move to __aenter__/__aexit__
@@ -231,8 +511,12 @@ class DemultiplexerSink(AudioSink):
             return
         self.deleted = True
         logger.debug(f"Deleting {self!r}")
-        for usersink in self.users.values():
-            await usersink.close()
+        await self.demux_task.stop()
+        await self.reap_task.stop()
+        for user in list(self.users):
+            await self.remove_user_sink(user)
+        await self.wakeword.stop()
+        await self.wakeword.close()
 
     async def demux_loop(self):
         logger.info(f'''
@@ -245,8 +529,9 @@ class DemultiplexerSink(AudioSink):
         async for voice_data in self.reader.listen_voice():
             try:
                 sink = self.get_user_sink(voice_data.user)
-                audio = Audio(data=voice_data.pcm, channels=2, width=2, rate=48000)
-                await sink.feed(audio)
+                audio = Audio(data=voice_data.pcm, channels=Decoder.CHANNELS, width=2, rate=Decoder.SAMPLING_RATE)
+                # Convert once per packet, all consumers of the sink share the result
+                await sink.feed(sink.resampler(audio))
             except Exception as exc:
                 logger.exception(f"Unexpected exception in {self!r}.demux_loop: {exc}")
 
@@ -255,51 +540,79 @@ class DemultiplexerSink(AudioSink):
             self.users[user] = UserSink(self, self.keywords, user)
         return self.users[user]
 
+    async def remove_user_sink(self, user):
+        sink = self.users.pop(user, None)
+        if sink is not None:
+            await sink.close()
+
+    async def reap_loop(self, interval=30):
+        """Close sinks of users who have been silent for `SINK_IDLE_TIMEOUT`"""
+        while True:
+            await asyncio.sleep(min(interval, SINK_IDLE_TIMEOUT / 4))
+            try:
+                now = time.monotonic()
+                idle = [user for user, sink in self.users.items()
+                        if not sink.busy and now - sink.last_active > SINK_IDLE_TIMEOUT]
+                for user in idle:
+                    logger.info(f"{self!r} hibernates idle {self.users[user]!r}")
+                    await self.remove_user_sink(user)
+                handles, gates = await self.wakeword.stats()
+                logger.log(
+                    logging.INFO if idle else logging.DEBUG,
+                    f"{self!r} live sinks={len(self.users)} wake word handles={handles} vads={gates} {self.clock!r} {self.barge_in!r}",
+                )
+            except Exception as exc:
+                logger.exception(f"Unexpected exception in {self!r}.reap_loop: {exc}")
+
     async def play_stream(self, stream):
         return await self.run_interruptible(self.play_stream_impl(stream))
 
     async def play_stream_impl(self, stream):
+        resampler = Resampler(channels=Encoder.CHANNELS, rate=Encoder.SAMPLING_RATE)
         async with self.speaking():
-            async for frame in rate_limit(size_limit(stream, Encoder.SAMPLES_PER_FRAME)):
-                await self.send_packet(frame)
-
-    async def play(self, sound: Audio):
+            async for frame in self.clock.produce(size_limit(resample(stream, resampler), Encoder.SAMPLES_PER_FRAME)):
+                if len(frame) < Encoder.SAMPLES_PER_FRAME:
+                    frame += frame.silence(Encoder.SAMPLES_PER_FRAME - len(frame))
+                if await self.clock.tick():
+                    await self.send_packet(frame)
+
+    async def play(self, sound: Union[Audio, Prompt]):
+        if isinstance(sound, Prompt):
+            return await self.play_prompt(sound)
+        sound = sound.to_stereo().to_rate(Encoder.SAMPLING_RATE)
         async with self.speaking():
-            async for packet in rate_limit(size_limit(aiter([sound]), Encoder.SAMPLES_PER_FRAME)):
+            async for packet in size_limit(aiter([sound]), Encoder.SAMPLES_PER_FRAME):
                 if len(packet) < Encoder.SAMPLES_PER_FRAME:
                     # To avoid "clatz" in the end
                     packet += packet.silence(Encoder.SAMPLES_PER_FRAME - len(packet))
-                await self.send_packet(packet)
+                if await self.clock.tick():
+                    await self.send_packet(packet)
+
+    async def play_prompt(self, prompt: Prompt):
+        async with self.speaking():
+            for packet in prompt.packets:
+                if await self.clock.tick():
+                    self.client.send_audio_packet(packet, encode=False)
 
     async def send_packet(self, packet: Audio):
-        self.client.send_audio_packet(packet.to_stereo().to_rate(Encoder.SAMPLING_RATE).data)
+        """Send 48 kHz stereo packet"""
+        self.client.send_audio_packet(bytes(packet.data))
 
-    async def play_loop(self, sound: Audio):
+    async def play_loop(self, sound: Union[Audio, Prompt]):
         async with self.speaking():
             while True:
                 await self.play(sound)
 
     async def run_interruptible(self, coro):
         logger.debug("Playing interruptible")
-        # FIXME: listen for users those entered chat after start
-        waiters = {sink.wait_for_wuw(): user for user, sink in self.users.items()}
-        done, pending = await asyncio.wait(list(waiters) + [coro], return_when=asyncio.FIRST_COMPLETED)
-        for task in pending:
-            task.cancel()
-            with suppress(asyncio.CancelledError):
-                await task
-        done_coro = done.pop().get_coro()
-        if done_coro in waiters:
-            logger.debug(f"Interrupted by {waiters[done_coro]}")
-            raise Interrupted
+        await self.barge_in.run(coro)
 
-    async def play_interruptible(self, audio: Audio):
+    async def play_interruptible(self, audio: Union[Audio, Prompt]):
         return await self.run_interruptible(self.play(audio))
 
     async def speak(self, text):
         logger.debug(f"Speaking: {text}")
-        audio = await text_to_speech(text=text)
-        await self.play_interruptible(audio)
+        await self.play_stream(text_to_speech_stream(text))
 
     @asynccontextmanager
     async def speaking(self):
@@ -310,20 +623,44 @@ class DemultiplexerSink(AudioSink):
                 async with self.speak_lock:
                     await self.client.ws.speak(SpeakingState.active())
                     self.is_speaking = True
+                    self.clock.reset()
                     yield
             finally:
                 self.is_speaking = False
                 await self.client.ws.speak(SpeakingState.inactive())
+                logger.debug(f"{self!r} {self.clock!r}")
 
     async def on_welcome(self, user):
         await self.get_user_sink(user).on_welcome()
 
+    async def on_leave(self, user):
+        await self.remove_user_sink(user)
+
+
+stt_latencies = {provider: LatencyTracker(provider.__name__) for provider in {google_cloud, yandex}}
+
 
 async def speech_to_text(audio: Audio):
+    primary, secondary = (yandex, google_cloud) if language.get() == 'ru' else (google_cloud, yandex)
+    if STT_HEDGE == 'off' or primary is secondary:
+        return await stt_latencies[primary].measure(primary.speech_to_text(audio))
+    delay = stt_latencies[primary].percentile(0.95) if STT_HEDGE == 'adaptive' else float(STT_HEDGE)
+    text = await hedge(
+        lambda: stt_latencies[primary].measure(primary.speech_to_text(audio)),
+        lambda: stt_latencies[secondary].measure(secondary.speech_to_text(audio)),
+        delay=delay,
+    )
+    logger.debug(f"Hedged STT after {delay:.3f}s: {list(stt_latencies.values())}")
+    if not text:
+        raise EmptyUtterance
+    return text
+
+
+def streaming_speech_to_text(chunks):
     if language.get() == 'ru':
-        return await yandex.speech_to_text(audio)
+        return yandex.streaming_speech_to_text(chunks)
     else:
-        return await google_cloud.speech_to_text(audio)
+        return google_cloud.streaming_speech_to_text(chunks)
 
 
 async def text_to_speech(text: str):
@@ -333,31 +670,33 @@ async def text_to_speech(text: str):
         return await google_cloud.text_to_speech(text)
 
 
+def text_to_speech_stream(text: str):
+    if language.get() == 'ru':
+        return yandex.text_to_speech_stream(text)
+    else:
+        return google_cloud.text_to_speech_stream(text)
+
+
 async def aiter(iter_):
     for i in iter_:
         yield i
 
 
+async def resample(audio_iter, resampler: Resampler):
+    async for packet in audio_iter:
+        yield resampler(packet)
+
+
 async def size_limit(audio_iter, size):
     buf = None
     async for packet in audio_iter:
-        buf = buf + packet if buf else packet
+        if buf is None:
+            buf = AudioBuffer.like(packet, capacity=size)
+        buf += packet
         while len(buf) >= size:
-            yield buf[:size]
-            buf = buf[size:]
+            yield buf.pop(size)
     if buf:
-        yield buf
-
-
-async def rate_limit(audio_iter):
-    when_to_wake = time.perf_counter()
-    async for packet in audio_iter:
-        yield packet
-        when_to_wake += packet.duration
-        to_sleep = when_to_wake - time.perf_counter()
-        await asyncio.sleep(to_sleep)
-    if packet:
-        yield packet
+        yield buf.pop(len(buf))
 
 
 class Interrupted(Exception):
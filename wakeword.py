@@ -0,0 +1,408 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from multiprocessing.shared_memory import SharedMemory
+from struct import Struct
+from typing import Dict, List, Optional, Tuple
+
+from pvporcupine import create
+from webrtcvad import Vad
+
+from utils import Audio, AudioBuffer, BackgroundTask, InferencePool, batch_rms
+
+logger = logging.getLogger(__name__)
+# Results of `WakeWordEngine.process`: keyword (if detected), processed and gated packets count
+GateResult = Tuple[Optional[str], int, int]
+
+
+class SpeechGate:
+    """
+    Cheap speech detector in front of the wake word engine.
+
+    Passes packets while webrtcvad hears speech above `rms_floor` and for `hangover` packets after it.
+    Last `preroll` gated packets are kept and passed on speech onset,
+    so a keyword started right at the onset is not cut.
+    """
+    def __init__(self, vad: Vad, rms_floor=50, preroll=15, hangover=25):
+        self.vad = vad
+        self.rms_floor = rms_floor
+        self.hangover = hangover
+        self.preroll = deque(maxlen=preroll)
+        self.remaining = 0
+        self.total = 0
+        self.processed = 0
+
+    def __str__(self):
+        return f'processed={self.processed} gated={self.gated}'
+
+    @property
+    def gated(self) -> int:
+        return self.total - self.processed
+
+    def is_speech(self, audio: Audio, rms: float = None) -> bool:
+        rms = audio.rms if rms is None else rms
+        return rms > self.rms_floor and self.vad.is_speech(audio.data, audio.rate)
+
+    def __call__(self, audio: Audio, rms: float = None) -> List[Audio]:
+        """Return packets to process, `rms` of the packet may be precomputed"""
+        self.total += 1
+        if self.is_speech(audio, rms):
+            packets = [*self.preroll, audio]
+            self.preroll.clear()
+            self.remaining = self.hangover
+        elif self.remaining:
+            packets = [audio]
+            self.remaining -= 1
+        else:
+            self.preroll.append(audio)
+            return []
+        self.processed += len(packets)
+        return packets
+
+
+class WakeWordEngine:
+    """
+    Blocking part of wake word detection: Porcupine handles, per-user speech gates and frame buffers.
+
+    Porcupine handles are taken from a bounded pool and leased to users who are speaking.
+    Users whose gate has been closed for `idle_timeout` give their handle back.
+    Not thread-safe: `WakeWordScheduler` calls it from a single worker.
+    """
+    def __init__(self, keywords: List[str], max_handles=4, idle_timeout=1.0, backlog=1.0, vad_mode=3):
+        self.keywords = keywords
+        self.max_handles = max_handles
+        self.idle_timeout = idle_timeout
+        self.vad_mode = vad_mode
+        self.handles = [self.create_handle()]
+        self.handles_count = 1
+        self.frame_length = self.handles[0].frame_length
+        self.sample_rate = self.handles[0].sample_rate
+        self.unpacker = Struct(f'{self.frame_length}h')
+        self.backlog = int(backlog * self.sample_rate)
+        self.leases = {}
+        self.gates = {}
+        self.buffers = {}
+        self.last_voice = {}
+
+    def __repr__(self):
+        return f'<{type(self).__name__}>[leased={len(self.leases)} handles={self.handles_count}/{self.max_handles}]'
+
+    def create_handle(self):
+        return create(keywords=self.keywords, sensitivities=[0.5] * len(self.keywords))
+
+    def close(self):
+        for key in list(self.leases):
+            self.release(key)
+        for handle in self.handles:
+            handle.delete()
+        self.handles = []
+
+    def gate(self, key) -> SpeechGate:
+        if key not in self.gates:
+            self.gates[key] = SpeechGate(Vad(self.vad_mode))
+        return self.gates[key]
+
+    def lease(self, key):
+        """Return Porcupine handle for `key` or None if all of them are busy"""
+        if key not in self.leases:
+            if self.handles:
+                self.leases[key] = self.handles.pop()
+            elif self.handles_count < self.max_handles:
+                self.leases[key] = self.create_handle()
+                self.handles_count += 1
+                logger.debug(f"{self!r} created handle for {key}")
+            else:
+                return None
+        return self.leases[key]
+
+    def release(self, key):
+        if key in self.leases:
+            self.handles.append(self.leases.pop(key))
+        self.buffers.pop(key, None)
+        self.last_voice.pop(key, None)
+
+    def forget(self, key):
+        """Drop all state of `key`, deleting handles no longer needed by the remaining users"""
+        self.release(key)
+        self.gates.pop(key, None)
+        while self.handles and self.handles_count > max(len(self.gates), 1):
+            self.handles.pop().delete()
+            self.handles_count -= 1
+
+    def stats(self) -> Tuple[int, int]:
+        """Porcupine handles and speech gates (with their Vad) alive"""
+        return self.handles_count, len(self.gates)
+
+    def detect(self, key, pcm: bytes) -> Optional[str]:
+        """Process one frame of `frame_length` samples"""
+        handle = self.lease(key)
+        if handle is None:
+            return
+        result = handle.process(self.unpacker.unpack(pcm))
+        if result >= 0:
+            return self.keywords[result]
+
+    def is_speech(self, key, pcm: bytes, rate: int) -> bool:
+        return self.gate(key).vad.is_speech(pcm, rate)
+
+    def process(self, batch: Dict[object, List[bytes]]) -> Dict[object, GateResult]:
+        """Gate and buffer packets of all users, then run Porcupine on all ready frames"""
+        now = time.monotonic()
+        audios = {
+            key: [Audio(channels=1, width=2, rate=self.sample_rate, data=pcm) for pcm in packets]
+            for key, packets in batch.items()
+        }
+        # Loudness of the whole tick in one pass instead of one audioop call per packet
+        loudness = iter(batch_rms([audio for packets in audios.values() for audio in packets]))
+        for key, packets in audios.items():
+            gate = self.gate(key)
+            for audio in packets:
+                for packet in gate(audio, next(loudness)):
+                    if key not in self.buffers:
+                        self.buffers[key] = AudioBuffer.like(packet, capacity=self.frame_length * 4)
+                    self.buffers[key] += packet
+                    self.last_voice[key] = now
+        for key in list(self.leases):
+            if now - self.last_voice.get(key, 0) > self.idle_timeout:
+                # Let somebody else use the handle
+                self.handles.append(self.leases.pop(key))
+        keywords = {}
+        for key, buffer in self.buffers.items():
+            if len(buffer) < self.frame_length:
+                continue
+            if self.lease(key) is None:
+                buffer.consume(max(len(buffer) - self.backlog, 0))
+                continue
+            while len(buffer) >= self.frame_length:
+                keyword = self.detect(key, bytes(buffer.pop(self.frame_length).data))
+                if keyword:
+                    buffer.clear()
+                    keywords[key] = keyword
+                    break
+        return {
+            key: (keywords.get(key), self.gates[key].processed, self.gates[key].gated)
+            for key in set(batch) | set(keywords)
+        }
+
+
+class SharedFrames:
+    """Shared memory block to hand packets over to a worker process without pickling them"""
+    def __init__(self, size=1 << 16):
+        self.shm = SharedMemory(create=True, size=size)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def write(self, batch: Dict[object, List[bytes]]) -> Dict[object, List[Tuple[int, int]]]:
+        """Copy packets into shared memory and return their (offset, size) layout"""
+        total = sum(len(pcm) for packets in batch.values() for pcm in packets)
+        if total > self.shm.size:
+            self.close()
+            self.shm = SharedMemory(create=True, size=max(total, 2 * self.shm.size))
+        layout = {}
+        offset = 0
+        for key, packets in batch.items():
+            layout[key] = []
+            for pcm in packets:
+                self.shm.buf[offset:offset + len(pcm)] = pcm
+                layout[key].append((offset, len(pcm)))
+                offset += len(pcm)
+        return layout
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+# Worker process state, see `WakeWordScheduler` in 'process' mode
+worker_engine: Optional[WakeWordEngine] = None
+worker_frames: Dict[str, SharedMemory] = {}
+
+
+def init_worker(keywords: List[str], engine_kwargs: dict):
+    global worker_engine
+    worker_engine = WakeWordEngine(keywords, **engine_kwargs)
+
+
+def worker_process(name: str, layout: Dict[object, List[Tuple[int, int]]]) -> Dict[object, GateResult]:
+    if name not in worker_frames:
+        for shm in worker_frames.values():
+            shm.close()
+        worker_frames.clear()
+        worker_frames[name] = SharedMemory(name=name)
+    buf = worker_frames[name].buf
+    return worker_engine.process({
+        key: [bytes(buf[offset:offset + size]) for offset, size in spans] for key, spans in layout.items()
+    })
+
+
+def worker_call(method: str, *args):
+    return getattr(worker_engine, method)(*args)
+
+
+class WakeWordScheduler:
+    """
+    Wake word detection for all users of a channel, off the event loop.
+
+    Packets fed by `UserSink`s of waiting users (or of all users while somebody watches)
+    are only queued on the loop.
+    Once per tick all of them are handed over to `WakeWordEngine`s in one call per shard,
+    running on dedicated `InferencePool`s either in threads or in processes
+    (then packets go through shared memory). Users are pinned to a shard,
+    so their results come back in order.
+    """
+    def __init__(self, keywords: List[str], mode='thread', shards=1, max_pending=4, tick=0.02, backlog=50,
+                 **engine_kwargs):
+        self.mode = mode
+        self.tick = tick
+        self.backlog = backlog
+        if mode == 'thread':
+            self.engines = [WakeWordEngine(keywords, **engine_kwargs) for _ in range(shards)]
+            self.pools = [InferencePool(mode, max_pending=max_pending) for _ in range(shards)]
+        else:
+            self.engines = None
+            self.pools = [
+                InferencePool(mode, max_pending=max_pending, initializer=init_worker, initargs=(keywords, engine_kwargs))
+                for _ in range(shards)
+            ]
+            self.frames = [SharedFrames() for _ in range(shards)]
+        self.pending = {}
+        self.sinks = {}
+        self.waiters = defaultdict(set)
+        self.subscribers = set()
+        self.watchers = 0
+        self.task = BackgroundTask()
+        self.closed = False
+
+    def __repr__(self):
+        return f'<{type(self).__name__}>[mode={self.mode} shards={len(self.pools)} waiting={len(self.waiters)}]'
+
+    def shard(self, sink) -> int:
+        return hash(sink.key) % len(self.pools)
+
+    async def call(self, sink, method: str, *args):
+        shard = self.shard(sink)
+        if self.engines:
+            return await self.pools[shard].run(getattr(self.engines[shard], method), sink.key, *args)
+        return await self.pools[shard].run(worker_call, method, sink.key, *args)
+
+    def start(self):
+        self.task.start(self.run())
+
+    async def stop(self):
+        await self.task.stop()
+
+    async def close(self):
+        self.closed = True
+        if self.engines:
+            for engine, pool in zip(self.engines, self.pools):
+                await pool.run(engine.close)
+        else:
+            for frames in self.frames:
+                frames.close()
+        for pool in self.pools:
+            pool.shutdown()
+
+    async def release(self, sink):
+        self.pending.pop(sink, None)
+        self.sinks.pop(sink.key, None)
+        if not self.closed:
+            await self.call(sink, 'release')
+
+    async def forget(self, sink):
+        """Drop all state of `sink` user, it is created again if the user comes back"""
+        self.pending.pop(sink, None)
+        self.sinks.pop(sink.key, None)
+        if not self.closed:
+            await self.call(sink, 'forget')
+
+    async def stats(self) -> Tuple[int, int]:
+        """Porcupine handles and speech gates alive over all shards"""
+        if self.engines:
+            stats = await asyncio.gather(*(pool.run(engine.stats) for engine, pool in zip(self.engines, self.pools)))
+        else:
+            stats = await asyncio.gather(*(pool.run(worker_call, 'stats') for pool in self.pools))
+        return sum(handles for handles, _ in stats), sum(gates for _, gates in stats)
+
+    def detect(self, sink, sound: Audio) -> Optional[str]:
+        """Process one frame synchronously"""
+        shard = self.shard(sink)
+        if self.engines:
+            return self.pools[shard].call(self.engines[shard].detect, sink.key, bytes(sound.data))
+        return self.pools[shard].call(worker_call, 'detect', sink.key, bytes(sound.data))
+
+    async def is_speech(self, sink, audio: Audio) -> bool:
+        return await self.call(sink, 'is_speech', bytes(audio.data), audio.rate)
+
+    async def wait(self, sink) -> str:
+        """Wait until `sink` user says a keyword and return it"""
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[sink].add(future)
+        try:
+            return await future
+        finally:
+            self.waiters[sink].discard(future)
+            if not self.waiters[sink]:
+                del self.waiters[sink]
+                await self.release(sink)
+
+    def subscribe(self, callback):
+        """Call `callback(sink, keyword, started)` on every detection, `started` is when its batch was taken"""
+        self.subscribers.add(callback)
+
+    @contextmanager
+    def watch(self):
+        """Detect keywords of all users, not only of the waiting ones"""
+        self.watchers += 1
+        try:
+            yield
+        finally:
+            self.watchers -= 1
+
+    def feed(self, sink, audio: Audio):
+        if sink not in self.waiters and not self.watchers:
+            # Nobody waits for a keyword from this user
+            return
+        if sink not in self.pending:
+            # Drop the oldest packets if the workers fall behind
+            self.pending[sink] = deque(maxlen=self.backlog)
+            self.sinks[sink.key] = sink
+        self.pending[sink].append(bytes(audio.data))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self.process()
+            except Exception as exc:
+                logger.exception(f"Unexpected exception in {self!r}.run: {exc}")
+
+    async def process(self):
+        started = time.monotonic()
+        pending, self.pending = self.pending, {}
+        batches = [{} for _ in self.pools]
+        for sink, packets in pending.items():
+            batches[self.shard(sink)][sink.key] = list(packets)
+        shards = [shard for shard, batch in enumerate(batches) if batch]
+        results = await asyncio.gather(*(self.process_shard(shard, batches[shard]) for shard in shards))
+        for shard_results in results:
+            for key, (keyword, processed, gated) in shard_results.items():
+                sink = self.sinks.get(key)
+                if sink is None:
+                    continue
+                sink.gate_processed, sink.gate_gated = processed, gated
+                if keyword:
+                    for future in self.waiters.get(sink, ()):
+                        if not future.done():
+                            future.set_result(keyword)
+                    for callback in self.subscribers:
+                        callback(sink, keyword, started)
+
+    async def process_shard(self, shard: int, batch: Dict[object, List[bytes]]) -> Dict[object, GateResult]:
+        if self.engines:
+            return await self.pools[shard].run(self.engines[shard].process, batch)
+        layout = self.frames[shard].write(batch)
+        return await self.pools[shard].run(worker_process, self.frames[shard].name, layout)
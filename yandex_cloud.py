@@ -1,13 +1,23 @@
+import asyncio
 import json
 import logging
 import os
+from typing import AsyncIterator
 
 import aiohttp
 
-from voice import language
-from utils import Audio
+import ogg
+from clients import clients
+from tts_cache import cache as tts_cache
+from utils import sync_to_async, Audio, AudioBuffer, Transcript, language, ordered_concurrently, split_sentences
 
 logger = logging.getLogger(__name__)
+TTS_VOICE = 'alena'
+TTS_RATE = 48000
+STT_URL = os.getenv('YANDEX_STT_URL', 'https://stt.api.cloud.yandex.net/speech/v1/stt:recognize')
+# Seconds between interim recognitions of a streamed utterance, 0 recognizes it once when it is over.
+# Every interim request uploads the whole utterance so far, so the cost grows quadratically with its length
+INTERIM_INTERVAL = float(os.getenv('YANDEX_INTERIM_INTERVAL', 0))
 
 
 def get_lang():
@@ -16,20 +26,23 @@ def get_lang():
 
 async def request_yandex(url: str, **kwargs):
     api_key = os.getenv('YANDEX_API_KEY')
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(url, **kwargs, headers=dict(Authorization=f'Api-Key {api_key}')) as response:
+    session = clients.http()
+    try:
+        async with clients.provider('yandex').limit() as timeout:
+            headers = dict(Authorization=f'Api-Key {api_key}')
+            async with session.post(url, **kwargs, headers=headers, timeout=timeout) as response:
                 body = await response.read()
                 response.raise_for_status()
                 return body
-        except aiohttp.client_exceptions.ClientResponseError as exc:
-            logger.exception(f"Unexpected exception while requesting Yandex.API: {exc} ({body})")
-            raise
+    except aiohttp.client_exceptions.ClientResponseError as exc:
+        logger.exception(f"Unexpected exception while requesting Yandex.API: {exc} ({body})")
+        raise
 
 
+@tts_cache.cached('yandex', voice=TTS_VOICE, rate=TTS_RATE)
 async def text_to_speech(text=None, ssml=None) -> Audio:
     logger.info(f"TTS: {text or ssml}")
-    rate = 48000
+    rate = TTS_RATE
     if text == ssml:
         raise ValueError("One and Only one of (text, ssml) must be set")
     elif text:
@@ -38,17 +51,60 @@ async def text_to_speech(text=None, ssml=None) -> Audio:
         kwargs = dict(ssml=ssml)
     data = await request_yandex(
         'https://tts.api.cloud.yandex.net/speech/v1/tts:synthesize',
-        data=dict(format='lpcm', voice='alena', sampleRateHertz=rate, lang=get_lang(), **kwargs),
+        data=dict(format='lpcm', voice=TTS_VOICE, sampleRateHertz=rate, lang=get_lang(), **kwargs),
     )
     return Audio(data=data, channels=1, rate=rate, width=2)
 
 
+async def text_to_speech_stream(text, parallelism=3) -> AsyncIterator[Audio]:
+    """Synthesize sentences concurrently and yield them in order as soon as each one is ready"""
+    sentences = split_sentences(text)
+    async for audio in ordered_concurrently((text_to_speech(text=sentence) for sentence in sentences), parallelism):
+        yield audio
+
+
 async def speech_to_text(speech: Audio):
+    if ogg.can_encode():
+        data = await sync_to_async(ogg.encode_ogg_opus, speech)
+        params = dict(format='oggopus')
+    else:
+        data = speech.to_mono().data
+        params = dict(format='lpcm', sampleRateHertz=speech.rate)  # TODO: add channels and width
     response = await request_yandex(
-        'https://stt.api.cloud.yandex.net/speech/v1/stt:recognize',
-        params=dict(format='lpcm', sampleRateHertz=speech.rate, lang=get_lang()),  # TODO: add channels and width
-        data=speech.to_mono().data,
+        STT_URL,
+        params=dict(**params, lang=get_lang()),
+        data=data,
     )
     result = json.loads(response)['result']
     logger.info(f"STT: {result}")
     return result
+
+
+async def streaming_speech_to_text(
+    chunks: AsyncIterator[Audio], interim_interval=INTERIM_INTERVAL,
+) -> AsyncIterator[Transcript]:
+    """
+    Chunked stand-in for streaming recognition: REST API v1 can't stream,
+    so the utterance is recognized once when `chunks` are over. With `interim_interval`
+    audio accumulated so far is also recognized every `interim_interval` seconds in background.
+    """
+    buffer = None
+    interim = None
+    recognized = 0
+    try:
+        async for chunk in chunks:
+            if buffer is None:
+                buffer = AudioBuffer.like(chunk)
+            buffer += chunk
+            if interim is not None and interim.done():
+                if not interim.exception() and interim.result():
+                    yield Transcript(text=interim.result(), is_final=False)
+                interim = None
+            if interim_interval and interim is None and buffer.duration - recognized >= interim_interval:
+                recognized = buffer.duration
+                interim = asyncio.create_task(speech_to_text(buffer.audio))
+    finally:
+        if interim is not None:
+            interim.cancel()
+    if buffer:
+        yield Transcript(text=await speech_to_text(buffer.audio), is_final=True)